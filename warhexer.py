@@ -13,12 +13,30 @@
 ##### Libraries #####
 import libtcodpy as libtcod	# roguelike library
 import os			# for an SDL window instruction
-from math import sqrt, ceil		# math functions
+from math import sqrt, ceil, log	# math functions
 from math import atan2, degrees, pi	# more math functions
 from textwrap import wrap	# for breaking up game messages
-import shelve   		# for saving and loading
-from random import shuffle	# for shuffling lists of items (used in map generation)
-#import time			# for animation timing
+import cPickle as pickle	# for saving and loading
+import shelve   		# for loading games saved by older versions
+import threading		# for writing saved games in the background
+import struct			# for packing saved games
+import zlib			# for compressing saved games
+import ctypes			# for replacing saved games on Windows
+from Queue import Queue		# for passing saved games to the save writer
+from heapq import heappush, heappop	# for the path finding open list
+from collections import OrderedDict	# for caches that drop their oldest entry
+from collections import deque	# for commands being replayed
+import sys			# for silencing simulation workers
+import argparse			# for command line arguments
+import time			# for timing simulated battles
+from multiprocessing import Pool, cpu_count	# for running simulated battles in parallel
+from multiprocessing import freeze_support	# for worker processes of the Windows executable
+from multiprocessing import TimeoutError	# for search workers that don't report in time
+from multiprocessing import RawValue	# for telling pondering workers to stop
+try:
+	import numpy		# for painting the map console and the AI influence map, optional
+except ImportError:
+	numpy = None
 
 
 ##### Constants #####
@@ -44,6 +62,25 @@ UNIT_HEIGHT = 7		# height "
 
 LIMIT_FPS = 30		# maximum frames-per-second displayed
 
+TERRAIN_CACHE_SIZE = 4	# number of painted maps kept in memory
+SPRITE_CACHE_SIZE = 64	# number of drawn unit sprites kept in memory
+JOURNAL_LENGTH = 20	# number of saves journaled before a full save
+SAVE_MAGIC = 'WHXS'	# start of a save file
+SAVE_VERSION = 3	# save file format version
+SAVE_HEADER = '<4sHHQ'	# struct format of the save file header
+SAVE_COMPRESSED = 1	# save file header flag for a compressed save
+MOVEFILE_REPLACE_EXISTING = 0x1	# Windows MoveFileEx flag to replace the destination file
+MOVEFILE_WRITE_THROUGH = 0x8	# Windows MoveFileEx flag to return only once the move is on disk
+COMPRESS_SAVES = True	# compress full saves
+REPLAY_DIR = 'replays'	# directory battle replays are written to
+REPLAY_DELAY = 500	# default milliseconds between replayed commands
+TRANSPOSITION_SIZE = 65536	# number of positions kept in an AI transposition table
+SEARCH_TARGETS = 3	# number of best targets each unit considers in an AI search
+SEARCH_EXPLORATION = 0.1	# how much the AI search tries plans it knows less about
+SEARCH_GRACE = 0.25	# seconds allowed for search workers to report after the time limit
+PONDER_SLICE = 0.25	# seconds each pondering AI search worker runs for at a time
+PONDER_POSITIONS = 64	# number of positions whose pondering is kept
+
 # terrain type codes
 OPEN_GROUND = 0
 FOREST = 1
@@ -138,15 +175,66 @@ UNIT_CLASS_DEFS = [
 	]
 
 
+# stream of random numbers for the battle rules, map generation, and AI
+# the whole state is one 64-bit number, so it can be saved with the battle and
+# a battle can be played out again from its seed (uses SplitMix64)
+class BattleRandom:
+	def __init__(self, seed):
+		self.state = seed & 0xFFFFFFFFFFFFFFFF
+	
+	# returns the next 64-bit random number
+	def Next(self):
+		self.state = (self.state + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+		z = self.state
+		z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+		z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+		return z ^ (z >> 31)
+	
+	# returns a random integer from low to high, inclusive
+	def GetInt(self, low, high):
+		return low + self.Next() % (high - low + 1)
+	
+	# shuffle a list in place
+	def Shuffle(self, items):
+		for i in range(len(items)-1, 0, -1):
+			j = self.GetInt(0, i)
+			items[i], items[j] = items[j], items[i]
+
+
 # battle object, keeps track of everything going on in the battle
+# seed starts the battle's random number stream, if not given the battle gets
+# a random seed
 class Battle:
-	def __init__(self):
+	def __init__(self, seed=None, map_seed=None):
 		self.map_hexes = []		# hex terrain
+		self.hex_map = {}		# hex terrain indexed by (hx, hy)
+		self.topology = None		# HexTopology of the map hexes
+		self.los_rows = {}		# LoS bitsets by (hx, hy), filled as needed
 		self.rivers = []		# coordinates of rivers (hx1, hy1, hx2, hy2)
 		self.roads = []			# coordinates of roads "
+		
+		# random numbers for everything that happens in the battle
+		if seed is None:
+			seed = libtcod.random_get_int(0, 0, 0x7FFFFFFF)
+		self.seed = seed		# starting seed, None if not known
+		self.rng = BattleRandom(seed)
+		self.commands = []		# commands given in the battle, for replays
+		
+		# seed for the terrain decorations, so the map looks the same every
+		# time it is painted
+		if map_seed is None:
+			map_seed = self.rng.GetInt(0, 0x7FFFFFFF)
+		self.map_seed = map_seed
 		self.units = []			# units in the battle
+		self.unit_map = {}		# units indexed by (hx, hy)
 		self.melee_locks = []		# list of pairs of units locked in melee
+		self.zobrist = 0		# Zobrist hash of the units and melee locks
+		self.unit_keys = {}		# Zobrist key of each unit's current state
+		self.undo_log = None		# changes since the first snapshot, if any
+		self.undo_saved = {}		# units, and the melee locks, saved since the latest snapshot
+		self.influence = None		# AI influence map for the current turn, built as needed
 		self.messages = []		# list of game messages
+		self.message_count = 0		# number of message lines ever added
 		
 		self.selected = None		# currently selected unit, if any
 		
@@ -158,9 +246,297 @@ class Battle:
 		self.player1_score = 0		# " 2
 	
 	
+	# lookup tables are not saved with the battle, they are rebuilt with
+	# BuildIndexes() after loading
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['hex_map']
+		del state['topology']
+		del state['los_rows']
+		del state['unit_map']
+		del state['zobrist']
+		del state['unit_keys']
+		del state['undo_log']
+		del state['undo_saved']
+		del state['influence']
+		return state
+	
+	
+	# rebuild lookup tables from the battle contents
+	def BuildIndexes(self):
+		self.hex_map = {}
+		for h in self.map_hexes:
+			self.hex_map[(h.hx, h.hy)] = h
+		self.BuildTopology()
+		self.los_rows = {}
+		self.unit_map = {}
+		for obj in self.units:
+			self.unit_map[(obj.hx, obj.hy)] = obj
+		self.BuildHash()
+		self.ClearSnapshots()
+	
+	
+	# work out the Zobrist hash of the battle position from scratch
+	def BuildHash(self):
+		self.zobrist = 0
+		self.unit_keys = {}
+		for obj in self.units:
+			self.unit_keys[obj] = 0
+			self.UpdateHash(obj)
+		for (obj1, obj2) in self.melee_locks:
+			self.zobrist ^= GetZobristKey(self.GetLockState(obj1, obj2))
+	
+	
+	# bring the Zobrist hash, and the influence map if there is one, up to
+	# date after a unit has changed
+	# units that have been removed from the battle are ignored
+	def UpdateHash(self, obj):
+		old_key = self.unit_keys.get(obj)
+		if old_key is None: return
+		key = GetZobristKey(obj.GetStateKey())
+		self.zobrist ^= old_key ^ key
+		self.unit_keys[obj] = key
+		if self.influence is not None:
+			self.influence.UpdateUnit(obj)
+	
+	
+	# toggle the Zobrist keys of the melee locks a unit is in, or of all
+	# locks if no unit is given; locks are hashed by the locations of their
+	# units, so this is done before and after units move
+	def HashLocks(self, obj=None):
+		if obj is not None and not obj.melee_locked: return
+		for (obj1, obj2) in self.melee_locks:
+			if obj is None or obj1 is obj or obj2 is obj:
+				self.zobrist ^= GetZobristKey(self.GetLockState(obj1, obj2))
+	
+	
+	# returns the hashable state of a melee lock between two units
+	def GetLockState(self, obj1, obj2):
+		return ('lock',) + tuple(sorted([(obj1.hx, obj1.hy), (obj2.hx, obj2.hy)]))
+	
+	
+	# returns a compact, hashable copy of the battle position: the state of
+	# every unit, the melee locks, and the active player
+	def GetState(self):
+		units = tuple(sorted([obj.GetStateKey() for obj in self.units]))
+		locks = tuple(sorted([self.GetLockState(obj1, obj2) for (obj1, obj2) in self.melee_locks]))
+		return (units, locks, self.active_player)
+	
+	
+	# returns the Zobrist hash of the battle position, positions with the same
+	# GetState() have the same hash
+	def GetStateHash(self):
+		return self.zobrist ^ GetZobristKey(('player', self.active_player))
+	
+	
+	# take a snapshot of the battle so that moves can be tried out and then
+	# taken back with Rollback()
+	# the snapshot itself only records the battle's turn, random number and
+	# message state; units and the melee locks are copied to the undo log the
+	# first time they change after the latest snapshot
+	def Snapshot(self):
+		if self.undo_log is None:
+			self.undo_log = []
+		self.undo_saved = {}
+		return (len(self.undo_log), self.active_player, self.current_turn,
+			self.rng.state, list(self.messages), self.message_count,
+			len(self.commands), self.selected)
+	
+	
+	# return the battle to how it was when a snapshot was taken, undoing
+	# only what has changed since
+	# snapshots taken after this one can no longer be used, but this one can
+	# be rolled back to again
+	def Rollback(self, snapshot):
+		(log_length, self.active_player, self.current_turn, rng_state, messages,
+			self.message_count, num_commands, self.selected) = snapshot
+		self.rng.state = rng_state
+		self.messages = list(messages)
+		del self.commands[num_commands:]
+		
+		# locks are hashed by unit location, so are left out of the hash
+		# while units are put back
+		self.HashLocks()
+		restored = []
+		while len(self.undo_log) > log_length:
+			entry = self.undo_log.pop()
+			if entry[0] == 'unit':
+				obj = entry[1]
+				if self.unit_map.get((obj.hx, obj.hy)) is obj:
+					del self.unit_map[(obj.hx, obj.hy)]
+				obj.SetUndoState(entry[2])
+				self.UpdateHash(obj)
+				restored.append(obj)
+			elif entry[0] == 'locks':
+				self.melee_locks = list(entry[1])
+			elif entry[0] == 'add':
+				obj = entry[1]
+				self.units.remove(obj)
+				if self.unit_map.get((obj.hx, obj.hy)) is obj:
+					del self.unit_map[(obj.hx, obj.hy)]
+				self.zobrist ^= self.unit_keys.pop(obj)
+				if self.influence is not None:
+					self.influence.RemoveUnit(obj)
+			elif entry[0] == 'remove':
+				obj = entry[1]
+				self.units.insert(entry[2], obj)
+				self.unit_keys[obj] = 0
+				self.UpdateHash(obj)
+				restored.append(obj)
+		self.HashLocks()
+		
+		# index units in their hexes once they are all back in place
+		for obj in restored:
+			if obj in self.unit_keys:
+				self.unit_map[(obj.hx, obj.hy)] = obj
+				obj.UpdateStatConsole()
+				obj.DrawSprite()
+		
+		self.undo_saved = {}
+		presenter.UpdateMessages()
+	
+	
+	# stop taking snapshots, keeping the battle as it is now
+	def ClearSnapshots(self):
+		self.undo_log = None
+		self.undo_saved = {}
+	
+	
+	# copy a unit to the undo log before it changes, unless it has already
+	# been copied since the latest snapshot
+	def SaveUnit(self, obj):
+		if self.undo_log is None or obj in self.undo_saved: return
+		self.undo_saved[obj] = True
+		self.undo_log.append(('unit', obj, obj.GetUndoState()))
+	
+	
+	# copy the melee locks to the undo log before they change, unless they
+	# have already been copied since the latest snapshot
+	def SaveLocks(self):
+		if self.undo_log is None or 'locks' in self.undo_saved: return
+		self.undo_saved['locks'] = True
+		self.undo_log.append(('locks', list(self.melee_locks)))
+	
+	
+	# returns a hash of everything that is painted on the map console
+	def GetMapHash(self):
+		hexes = []
+		for h in self.map_hexes:
+			hexes.append((h.hx, h.hy, h.terrain_type, h.road, h.river, h.landmark_name))
+		return hash((tuple(hexes), tuple(self.rivers), tuple(self.roads), self.map_seed))
+	
+	
+	# add a terrain hex to the map
+	# BuildTopology() must be called once all the map hexes have been added
+	def AddHex(self, h):
+		self.map_hexes.append(h)
+		self.hex_map[(h.hx, h.hy)] = h
+	
+	
+	# get the topology tables for the current map hexes, maps with the same
+	# shape share the same tables
+	def BuildTopology(self):
+		hexes = tuple([(h.hx, h.hy) for h in self.map_hexes])
+		if hexes not in topology_cache:
+			topology_cache[hexes] = HexTopology(hexes)
+		self.topology = topology_cache[hexes]
+		self.influence = None
+	
+	
+	# returns True if there is LoS from hx1, hy1 to hx2, hy2
+	# LoS from each hex to every other hex is worked out the first time it's
+	# needed and stored as a bitset, with one bit for each map hex
+	def HasLoS(self, hx1, hy1, hx2, hy2):
+		row = self.los_rows.get((hx1, hy1))
+		if row is None:
+			row = 0
+			for (i, (hx, hy)) in enumerate(self.topology.hexes):
+				if not TraceLoS(hx1, hy1, hx, hy):
+					row |= 1 << i
+			self.los_rows[(hx1, hy1)] = row
+		return (row >> self.topology.index[(hx2, hy2)]) & 1 == 1
+	
+	
+	# forget all stored LoS, must be called whenever map terrain changes
+	def ClearLoS(self):
+		self.los_rows = {}
+	
+	
+	# returns the AI influence map, working it out for all units if it has
+	# been cleared since it was last needed
+	def GetInfluence(self):
+		if self.influence is None:
+			self.influence = InfluenceMap(self.topology, self.units)
+		return self.influence
+	
+	
+	# forget the influence map, it's worked out again from scratch the next
+	# time it's needed
+	def ClearInfluence(self):
+		self.influence = None
+	
+	
+	# add a unit to the battle
+	def AddUnit(self, obj):
+		self.units.append(obj)
+		self.unit_map[(obj.hx, obj.hy)] = obj
+		self.unit_keys[obj] = 0
+		if self.undo_log is not None:
+			self.undo_log.append(('add', obj))
+		self.UpdateHash(obj)
+	
+	
+	# remove a unit from the battle
+	def RemoveUnit(self, obj):
+		if self.undo_log is not None:
+			self.undo_log.append(('remove', obj, self.units.index(obj)))
+		self.units.remove(obj)
+		if self.unit_map.get((obj.hx, obj.hy)) is obj:
+			del self.unit_map[(obj.hx, obj.hy)]
+		self.zobrist ^= self.unit_keys.pop(obj, 0)
+		if self.influence is not None:
+			self.influence.RemoveUnit(obj)
+	
+	
+	# move a unit to a new hex
+	# a unit moving along a path may pass through a hex held by a friendly
+	# unit, in which case that unit stays indexed in its hex
+	def MoveUnit(self, obj, hx, hy):
+		self.SaveUnit(obj)
+		if self.unit_map.get((obj.hx, obj.hy)) is obj:
+			del self.unit_map[(obj.hx, obj.hy)]
+		self.HashLocks(obj)
+		obj.hx = hx
+		obj.hy = hy
+		if (hx, hy) not in self.unit_map:
+			self.unit_map[(hx, hy)] = obj
+		self.HashLocks(obj)
+		self.UpdateHash(obj)
+	
+	
+	# swap the locations of two units
+	def SwapUnits(self, obj1, obj2):
+		self.SaveUnit(obj1)
+		self.SaveUnit(obj2)
+		self.HashLocks(obj1)
+		self.HashLocks(obj2)
+		obj1.hx, obj2.hx = obj2.hx, obj1.hx
+		obj1.hy, obj2.hy = obj2.hy, obj1.hy
+		self.unit_map[(obj1.hx, obj1.hy)] = obj1
+		self.unit_map[(obj2.hx, obj2.hy)] = obj2
+		self.HashLocks(obj1)
+		self.HashLocks(obj2)
+		self.UpdateHash(obj1)
+		self.UpdateHash(obj2)
+	
+	
 	# create a new melee lock between two enemy units
 	def CreateMeleeLock(self, obj1, obj2):
+		self.SaveLocks()
+		self.SaveUnit(obj1)
+		self.SaveUnit(obj2)
 		self.melee_locks.append((obj1, obj2))
+		self.zobrist ^= GetZobristKey(self.GetLockState(obj1, obj2))
 		
 		# update unit flags and their stat consoles
 		for obj in [obj1, obj2]:
@@ -178,9 +554,14 @@ class Battle:
 	
 	# break any melee locks that this unit is in
 	def BreakLocks(self, obj):
+		self.SaveLocks()
+		for obj1 in self.units:
+			if obj1.melee_locked:
+				self.SaveUnit(obj1)
 		for (obj1, obj2) in self.melee_locks[::-1]:
 			if obj1 == obj or obj2 == obj:
 				self.melee_locks.remove((obj1, obj2))
+				self.zobrist ^= GetZobristKey(self.GetLockState(obj1, obj2))
 				obj1.UpdateStatConsole()
 				obj2.UpdateStatConsole()
 		
@@ -197,6 +578,232 @@ class Battle:
 				obj2.UpdateStatConsole()
 
 
+# search results stored by battle state hash, so that a lookahead AI can reuse
+# the evaluation of a position it reaches by a different order of moves
+# once full, the least recently used positions are dropped
+class TranspositionTable:
+	def __init__(self, size=TRANSPOSITION_SIZE):
+		self.size = size		# maximum number of positions kept
+		self.entries = OrderedDict()	# stored values by state hash
+		self.hits = 0			# number of lookups that found a value
+		self.misses = 0			# " that did not
+	
+	
+	# returns the value stored for a state hash, or None if there isn't one
+	def Get(self, state_hash):
+		value = self.entries.pop(state_hash, None)
+		if value is None:
+			self.misses += 1
+			return None
+		self.entries[state_hash] = value
+		self.hits += 1
+		return value
+	
+	
+	# store a value for a state hash
+	def Put(self, state_hash, value):
+		self.entries.pop(state_hash, None)
+		self.entries[state_hash] = value
+		if len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+	
+	
+	# forget all stored values
+	def Clear(self):
+		self.entries.clear()
+		self.hits = 0
+		self.misses = 0
+
+
+# neighbour, ring and distance tables for a set of map hexes
+# only depends on which hexes are on the map, so is built once per map shape
+class HexTopology:
+	def __init__(self, hexes):
+		self.neighbours = {}		# adjacent hexes by direction, (-1, -1, -1) if off map
+		self.rings = {}			# hexes at each distance, in map order
+		self.disks = {}			# hexes within each distance, in map order, built as needed
+		self.distances = {}		# distance between every pair of hexes
+		self.index = {}			# position of each hex in the map hex list
+		self.distance_rows = []		# distances from each hex to every hex, in map order
+		self.adjacent_rows = []		# 1 for each hex next to each hex, 0 otherwise, in map order
+		
+		for (i, (hx, hy)) in enumerate(hexes):
+			self.index[(hx, hy)] = i
+		
+		on_map = set(hexes)
+		for (hx, hy) in hexes:
+			adjacents = []
+			for direction in range(6):
+				hx2, hy2 = GetHexInDir(hx, hy, direction)
+				if (hx2, hy2) in on_map:
+					adjacents.append((direction, hx2, hy2))
+				else:
+					adjacents.append((-1, -1, -1))
+			self.neighbours[(hx, hy)] = adjacents
+		
+		for (hx1, hy1) in hexes:
+			rings = []
+			for (hx2, hy2) in hexes:
+				xd = hx2 - hx1
+				yd = hy2 - hy1
+				distance = max(abs(xd), abs(yd), abs(yd - xd))
+				self.distances[(hx1, hy1, hx2, hy2)] = distance
+				while len(rings) <= distance:
+					rings.append([])
+				rings[distance].append((hx2, hy2))
+			self.rings[(hx1, hy1)] = rings
+		self.hexes = hexes
+		
+		for (hx1, hy1) in hexes:
+			self.distance_rows.append([self.distances[(hx1, hy1, hx2, hy2)] for (hx2, hy2) in hexes])
+			row = [0] * len(hexes)
+			for (direction, hx2, hy2) in self.neighbours[(hx1, hy1)]:
+				if direction != -1:
+					row[self.index[(hx2, hy2)]] = 1
+			self.adjacent_rows.append(row)
+		
+		# with numpy, the rows are the rows of a matrix so that many can be
+		# added up at once
+		if numpy is not None:
+			self.distance_rows = numpy.array(self.distance_rows, dtype=numpy.int_)
+			self.adjacent_rows = numpy.array(self.adjacent_rows, dtype=numpy.int_)
+	
+	
+	# returns the list of map hexes exactly distance away from hx, hy
+	def GetRing(self, hx, hy, distance):
+		rings = self.rings[(hx, hy)]
+		if distance >= len(rings):
+			return []
+		return rings[distance]
+	
+	
+	# returns the list of map hexes within distance of hx, hy
+	def GetDisk(self, hx, hy, distance):
+		rings = self.rings[(hx, hy)]
+		distance = min(distance, len(rings) - 1)
+		if (hx, hy, distance) not in self.disks:
+			disk = []
+			for (hx2, hy2) in self.hexes:
+				if self.distances[(hx, hy, hx2, hy2)] <= distance:
+					disk.append((hx2, hy2))
+			self.disks[(hx, hy, distance)] = disk
+		return self.disks[(hx, hy, distance)]
+
+
+# AI influence map, scores every map hex for each player by how close it is to
+# that player's units, and how many of them, and how many unbroken ones, are
+# next to it
+# worked out for all units at once, with array operations if numpy is
+# available, then kept up to date one unit at a time as units change
+class InfluenceMap:
+	def __init__(self, topology, units):
+		self.topology = topology
+		self.entries = {}		# player, hex index and broken each unit was added with
+		self.proximity = []		# sum of 40 - distance to each unit, halved for broken units
+		self.support = []		# number of units next to each hex
+		self.unbroken = []		# number of unbroken units next to each hex
+		for player in range(2):
+			if numpy is not None:
+				self.proximity.append(numpy.zeros(len(topology.hexes), dtype=numpy.int_))
+				self.support.append(numpy.zeros(len(topology.hexes), dtype=numpy.int_))
+				self.unbroken.append(numpy.zeros(len(topology.hexes), dtype=numpy.int_))
+			else:
+				self.proximity.append([0] * len(topology.hexes))
+				self.support.append([0] * len(topology.hexes))
+				self.unbroken.append([0] * len(topology.hexes))
+		
+		if numpy is None:
+			for obj in units:
+				self.UpdateUnit(obj)
+			return
+		
+		for player in range(2):
+			entries = []
+			for obj in units:
+				if obj.player == player:
+					entry = self.GetEntry(obj)
+					self.entries[obj] = entry
+					entries.append(entry)
+			if len(entries) == 0: continue
+			indexes = numpy.array([entry[1] for entry in entries])
+			broken = numpy.array([entry[2] for entry in entries], dtype=bool)
+			proximity = 40 - topology.distance_rows[indexes]
+			proximity[broken] //= 2
+			adjacent = topology.adjacent_rows[indexes]
+			self.proximity[player] = proximity.sum(axis=0)
+			self.support[player] = adjacent.sum(axis=0)
+			self.unbroken[player] = adjacent[~broken].sum(axis=0)
+	
+	
+	# returns what a unit adds to the map
+	def GetEntry(self, obj):
+		return (obj.player, self.topology.index[(obj.hx, obj.hy)], obj.broken)
+	
+	
+	# add a unit to the map, or bring it up to date if it has changed
+	def UpdateUnit(self, obj):
+		entry = self.GetEntry(obj)
+		old_entry = self.entries.get(obj)
+		if entry == old_entry: return
+		if old_entry is not None:
+			self.AddEntry(old_entry, -1)
+		self.AddEntry(entry, 1)
+		self.entries[obj] = entry
+	
+	
+	# take a unit off the map
+	def RemoveUnit(self, obj):
+		old_entry = self.entries.pop(obj, None)
+		if old_entry is not None:
+			self.AddEntry(old_entry, -1)
+	
+	
+	# add a unit's entry to the map, or take it off if sign is -1
+	def AddEntry(self, entry, sign):
+		(player, i, broken) = entry
+		distances = self.topology.distance_rows[i]
+		adjacent = self.topology.adjacent_rows[i]
+		if numpy is not None:
+			proximity = 40 - distances
+			if broken:
+				proximity //= 2
+			self.proximity[player] += sign * proximity
+			self.support[player] += sign * adjacent
+			if not broken:
+				self.unbroken[player] += sign * adjacent
+			return
+		
+		proximity_row = self.proximity[player]
+		support_row = self.support[player]
+		unbroken_row = self.unbroken[player]
+		for j in range(len(distances)):
+			proximity = 40 - distances[j]
+			if broken:
+				proximity = proximity // 2
+			proximity_row[j] += sign * proximity
+			if adjacent[j]:
+				support_row[j] += sign
+				if not broken:
+					unbroken_row[j] += sign
+	
+	
+	# returns the proximity score of the enemies of player for a hex
+	def GetProximity(self, hx, hy, player):
+		return int(self.proximity[1 - player][self.topology.index[(hx, hy)]])
+	
+	
+	# returns the number of units of player next to a hex, less the number
+	# of their enemies
+	def GetSupport(self, hx, hy, player):
+		i = self.topology.index[(hx, hy)]
+		return int(self.support[player][i] - self.support[1 - player][i])
+	
+	
+	# returns the number of unbroken enemies of player next to a hex
+	def GetUnbrokenEnemies(self, hx, hy, player):
+		return int(self.unbroken[1 - player][self.topology.index[(hx, hy)]])
+
+
 # session object, holds stuff unique to the gaming session and not saved between games
 class Session:
 	def __init__(self):
@@ -211,12 +818,32 @@ class Session:
 		
 		# create message console
 		self.msg_con = libtcod.console_new(CON_WIDTH-4, MSG_CON_HEIGHT)
+		
+		# RenderAll only redraws what has changed since it was last called;
+		# these record what was drawn and count changes to consoles
+		self.full_redraw = True		# redraw the whole screen next time
+		self.drawn_units = {}		# screen area and sprite key of each unit drawn
+		self.drawn_locks = []		# screen locations of melee lock markers drawn
+		self.drawn_panel = None		# contents of the info panel drawn
+		self.stat_versions = {}		# times each unit stat console has been updated
+		self.terrain_version = 0	# times the terrain console has been updated
+		self.terrain_hex = None		# hex shown on the terrain console, None if off map
+		self.msg_version = 0		# times the message console has been updated
 	
 	
 	# update the terrain console with info from hex
+	# nothing changes while the mouse moves within the same hex, or off the map
 	def UpdateTerrainCon(self, hx, hy):
+		terrain_hex = None
+		if HexIsOnMap(hx, hy):
+			terrain_hex = (hx, hy)
+		if terrain_hex == self.terrain_hex:
+			return
+		self.terrain_hex = terrain_hex
+		
+		self.terrain_version += 1
 		libtcod.console_clear(self.terrain_con)
-		if not HexIsOnMap(hx, hy):
+		if terrain_hex is None:
 			return
 		h = GetHexFromMap(hx, hy)
 		
@@ -254,6 +881,7 @@ class Session:
 	# update the message console with game messages
 	# color not used for now
 	def UpdateMsgConsole(self):
+		self.msg_version += 1
 		libtcod.console_clear(self.msg_con)
 		y = 0
 		for (line, color) in battle.messages:
@@ -266,6 +894,326 @@ class Session:
 			y += 1
 
 
+# presenter: receives display events from the battle rules
+# this base presenter displays nothing, never pauses, and answers No to any
+# prompt, so battles can be run headless in batch or in tests
+class Presenter:
+	rendering = False		# true if unit consoles and sprites are drawn
+
+	# redraw the screen
+	def Render(self):
+		pass
+
+	# hold the current display for a number of milliseconds
+	def Pause(self, ms):
+		pass
+
+	# animate a unit moving from its current hex into hx2, hy2
+	def AnimateMove(self, obj, hx2, hy2):
+		pass
+
+	# display a line of sight check from obj1 to obj2
+	def ShowLoS(self, obj1, obj2):
+		pass
+
+	# display the results of an attack roll; dice is (d1, d2, d3, d4), att and dff
+	# are the attack and defense roll success flags
+	def ShowAttack(self, obj1, obj2, attack_value, defense_value, dice, att, dff, result_text, footer_text):
+		pass
+
+	# display AI scores for a list of (score, hx, hy) hexes, and mark target hexes
+	def ShowScores(self, scored_list, target_hexes=[]):
+		pass
+
+	# get a yes or no answer to a prompt, defaults to No
+	def GetYN(self, text):
+		return False
+
+	# game messages have changed
+	def UpdateMessages(self):
+		pass
+
+
+# presenter that draws everything to the libtcod root console, with animations,
+# pauses and blocking prompts
+class ConsolePresenter(Presenter):
+	rendering = True
+
+	def Render(self):
+		RenderAll()
+
+	def Pause(self, ms):
+		libtcod.sys_sleep_milli(ms)
+
+	def AnimateMove(self, obj, hx2, hy2):
+		x1, y1 = Hex2Screen(obj.hx, obj.hy)
+		x2, y2 = Hex2Screen(hx2, hy2)
+		points = GetLine(x1, y1, x2, y2)
+		for (x, y) in points:
+			obj.x_offset = x
+			obj.y_offset = y
+			RenderAll()
+		obj.x_offset = 0
+		obj.y_offset = 0
+
+	def ShowLoS(self, obj1, obj2):
+		RenderAll()
+		x1, y1 = Hex2Screen(obj1.hx, obj1.hy, center=True)
+		x2, y2 = Hex2Screen(obj2.hx, obj2.hy, center=True)
+		points = GetLine(x1, y1, x2, y2)
+		for (x, y) in points:
+			libtcod.console_set_char_background(0, x, y, libtcod.white, flag=libtcod.BKGND_SET)
+		libtcod.console_flush()
+		libtcod.sys_sleep_milli(600)
+		session.full_redraw = True
+
+	def ShowAttack(self, obj1, obj2, attack_value, defense_value, dice, att, dff, result_text, footer_text):
+		con = session.battle_console
+
+		# display combat window
+		libtcod.console_clear(con)
+
+		# names
+		libtcod.console_print(con, 2, 1, obj1.name)
+		libtcod.console_set_default_foreground(con, libtcod.red)
+		libtcod.console_print_ex(con, BATTLE_CONSOLE_WIDTH/2, 1,
+			libtcod.BKGND_NONE, libtcod.CENTER, '>> attacking >>')
+		libtcod.console_set_default_foreground(con, libtcod.white)
+		libtcod.console_print_ex(con, BATTLE_CONSOLE_WIDTH-3, 1,
+			libtcod.BKGND_NONE, libtcod.RIGHT, obj2.name)
+
+		# portraits
+		libtcod.console_blit(obj1.portrait, 0, 0, 15, 13, con, 1, 3)
+		libtcod.console_blit(obj2.portrait, 0, 0, 15, 13, con, BATTLE_CONSOLE_WIDTH-16, 3)
+
+		# attack and defense values
+		libtcod.console_print(con, 18, 3, 'Attack')
+		libtcod.console_print(con, 21, 4, str(attack_value))
+
+		libtcod.console_print_ex(con, BATTLE_CONSOLE_WIDTH-19, 3,
+			libtcod.BKGND_NONE, libtcod.RIGHT, 'Defense')
+		libtcod.console_print_ex(con, BATTLE_CONSOLE_WIDTH-22, 4,
+			libtcod.BKGND_NONE, libtcod.RIGHT, str(defense_value))
+
+		def DisplayDie(x, y, value):
+			libtcod.console_rect(con, x, y, 3, 3, True, flag=libtcod.BKGND_SET)
+
+			if 4 <= value <= 6:
+				libtcod.console_put_char(con, x, y, 7)	# top left and bottom right
+				libtcod.console_put_char(con, x+2, y+2, 7)
+			if value > 1:
+				libtcod.console_put_char(con, x+2, y, 7)	# top right and bottom left
+				libtcod.console_put_char(con, x, y+2, 7)
+			if IsOdd(value):
+				libtcod.console_put_char(con, x+1, y+1, 7)	# center
+			if value == 6:
+				libtcod.console_put_char(con, x, y+1, 7)	# center left and right
+				libtcod.console_put_char(con, x+2, y+1, 7)
+
+		# display a number of tumbling dice, pausing after each, then settle
+		# on the actual roll
+		libtcod.console_set_default_foreground(con, libtcod.black)
+		libtcod.console_set_default_background(con, libtcod.white)
+		ROLLS = 5
+		for r in range(ROLLS):
+			if r == ROLLS-1:
+				(d1, d2, d3, d4) = dice
+			else:
+				d1, d2 = libtcod.random_get_int(0, 1, 6), libtcod.random_get_int(0, 1, 6)
+				d3, d4 = libtcod.random_get_int(0, 1, 6), libtcod.random_get_int(0, 1, 6)
+
+			DisplayDie(18, 10, d1)
+			DisplayDie(22, 10, d2)
+			DisplayDie(BATTLE_CONSOLE_WIDTH-20, 10, d3)
+			DisplayDie(BATTLE_CONSOLE_WIDTH-24, 10, d4)
+
+			libtcod.console_blit(con, 0, 0, BATTLE_CONSOLE_WIDTH,
+				BATTLE_CONSOLE_HEIGHT, 0, (SCREEN_WIDTH/2)-(BATTLE_CONSOLE_WIDTH/2),
+				(SCREEN_HEIGHT/2)-(BATTLE_CONSOLE_HEIGHT/2))
+			libtcod.console_flush()
+			libtcod.sys_sleep_milli(80)
+		libtcod.console_set_default_background(con, libtcod.black)
+
+		# roll results
+		for (success, x) in [(att, 22), (dff, BATTLE_CONSOLE_WIDTH-20)]:
+			if success:
+				text = 'Success!'
+				libtcod.console_set_default_foreground(con, libtcod.light_azure)
+			else:
+				text = 'Failed'
+				libtcod.console_set_default_foreground(con, libtcod.red)
+			libtcod.console_print_ex(con, x, 14, libtcod.BKGND_NONE, libtcod.CENTER, text)
+		libtcod.console_set_default_foreground(con, libtcod.white)
+
+		# display result
+		libtcod.console_print_ex(con, BATTLE_CONSOLE_WIDTH/2, 15,
+			libtcod.BKGND_NONE, libtcod.CENTER, result_text)
+		if footer_text is not None:
+			libtcod.console_print_ex(con, BATTLE_CONSOLE_WIDTH/2, 16,
+				libtcod.BKGND_NONE, libtcod.CENTER, footer_text)
+
+		libtcod.console_print_ex(con, BATTLE_CONSOLE_WIDTH/2, 17,
+			libtcod.BKGND_NONE, libtcod.CENTER, 'Space to Continue')
+
+		# blit battle console to screen and wait for space
+		libtcod.console_blit(con, 0, 0, BATTLE_CONSOLE_WIDTH,
+				BATTLE_CONSOLE_HEIGHT, 0, (SCREEN_WIDTH/2)-(BATTLE_CONSOLE_WIDTH/2),
+				(SCREEN_HEIGHT/2)-(BATTLE_CONSOLE_HEIGHT/2))
+		libtcod.console_flush()
+		session.full_redraw = True
+
+		self.WaitForPlayer()
+
+	def ShowScores(self, scored_list, target_hexes=[]):
+		for (score, hx, hy) in scored_list:
+			x, y = Hex2Screen(hx, hy, center=True)
+			text = str(score)
+			libtcod.console_print_ex(0, x, y, libtcod.BKGND_NONE, libtcod.CENTER, text)
+		for (hx, hy) in target_hexes:
+			x, y = Hex2Screen(hx, hy, center=True)
+			libtcod.console_print_ex(0, x, y, libtcod.BKGND_NONE, libtcod.CENTER, '*')
+		libtcod.console_flush()
+		libtcod.sys_sleep_milli(200)
+		session.full_redraw = True
+
+	def GetYN(self, text):
+		return GetYNWindow(text)
+
+	def UpdateMessages(self):
+		session.UpdateMsgConsole()
+
+	# wait for the player to look at a result before carrying on
+	def WaitForPlayer(self):
+		WaitForSpace()
+
+
+# presenter for watching a replay: draws everything like the console
+# presenter, but carries on by itself after a delay rather than waiting for
+# the player
+class ReplayPresenter(ConsolePresenter):
+	def __init__(self, delay):
+		self.delay = delay		# milliseconds to hold each result
+
+	def WaitForPlayer(self):
+		libtcod.sys_sleep_milli(self.delay)
+
+
+# writes saved games to disk on a background thread, so that saving does not
+# hold up the game
+class SaveWriter:
+	def __init__(self):
+		self.queue = Queue()
+		self.thread = threading.Thread(target=self.Run)
+		self.thread.daemon = True
+		self.thread.start()
+	
+	# write each saved game as it is queued
+	def Run(self):
+		while True:
+			(filename, data, append) = self.queue.get()
+			try:
+				if append:
+					AppendSaveFile(filename, data)
+				else:
+					WriteSaveFile(filename, data)
+			except (IOError, OSError) as e:
+				print 'ERROR: Could not write ' + filename + ': ' + str(e)
+			self.queue.task_done()
+	
+	# queue saved game data to be written to a file
+	def Write(self, filename, data):
+		self.queue.put((filename, data, False))
+	
+	# queue saved game data to be added to the end of a file
+	def Append(self, filename, data):
+		self.queue.put((filename, data, True))
+	
+	# wait until all queued saves have been written
+	def Wait(self):
+		self.queue.join()
+
+
+# records what has changed in a battle since it was last saved, so that most
+# saves only have to add the changes to the journal file rather than write the
+# whole battle
+# units are recorded by id: their place in the unit list when the journal was
+# started, with units added later numbered after them
+class SaveJournal:
+	def __init__(self, battle, journal_id):
+		self.battle = battle
+		self.journal_id = journal_id	# matches journal entries to their full save
+		self.entries = 0		# number of entries recorded
+		self.unit_ids = {}		# ids of units, indexed by unit
+		self.next_unit_id = 0		# id of the next unit added
+		self.unit_records = {}		# last recorded unit records, by id
+		self.message_count = 0		# battle message count when last recorded
+		self.command_count = 0		# number of battle commands when last recorded
+	
+	
+	# returns the state of the battle packed for a save file
+	# a full record holds every unit and message, otherwise only units that
+	# have changed and messages added since the last record are included
+	def Record(self, full=False):
+		for obj in self.battle.units:
+			if obj not in self.unit_ids:
+				self.unit_ids[obj] = self.next_unit_id
+				self.next_unit_id += 1
+		
+		records = []
+		unit_records = {}
+		for obj in self.battle.units:
+			unit_id = self.unit_ids[obj]
+			record = PackUnit(obj, unit_id)
+			if full or self.unit_records.get(unit_id) != record:
+				records.append(record)
+			unit_records[unit_id] = record
+		self.unit_records = unit_records
+		
+		# messages beyond the end of the message list have already been dropped
+		num_messages = len(self.battle.messages)
+		if not full:
+			num_messages = min(num_messages, self.battle.message_count - self.message_count)
+		messages = self.battle.messages[len(self.battle.messages)-num_messages:]
+		self.message_count = self.battle.message_count
+		
+		commands = self.battle.commands
+		if not full:
+			commands = commands[self.command_count:]
+			self.entries += 1
+		self.command_count = len(self.battle.commands)
+		return PackBattleState(self.battle, self.unit_ids, records, messages, commands)
+
+
+# reads packed values in order from saved game data, written in the given
+# save format version
+class SaveReader:
+	def __init__(self, data, version):
+		self.data = data
+		self.version = version
+		self.offset = 0
+	
+	# returns the number of bytes left to read
+	def Remaining(self):
+		return len(self.data) - self.offset
+	
+	# returns the next values, unpacked with the given struct format
+	def Read(self, fmt):
+		values = struct.unpack_from(fmt, self.data, self.offset)
+		self.offset += struct.calcsize(fmt)
+		return values
+	
+	# returns the next length bytes
+	def ReadBytes(self, length):
+		data = self.data[self.offset:self.offset+length]
+		self.offset += length
+		return data
+	
+	# returns the next packed string
+	def ReadString(self):
+		(length,) = self.Read('<H')
+		return self.ReadBytes(length)
+
+
 # records type of terrain in a given hex
 class Hex:
 	def __init__(self, hx, hy, terrain_type):
@@ -279,7 +1227,11 @@ class Hex:
 	
 	
 	# set hex terrain features
+	# must be called whenever terrain_type changes, so that LoS is rechecked
 	def SetTerrain(self):
+		if battle is not None:
+			battle.ClearLoS()
+		
 		if self.terrain_type == OPEN_GROUND:
 			self.color = OPEN_GROUND_COLOR
 			self.move_cost = 1
@@ -306,7 +1258,7 @@ class Hex:
 
 # unit in the battle: infantry, cavalry, etc.
 class Unit:
-	def __init__(self, name, player, hx, hy, facing):
+	def __init__(self, name, player, hx, hy, facing, consoles=True):
 		
 		self.name = name		# unit type name
 		self.player = player		# owning player number, 0-1
@@ -326,6 +1278,8 @@ class Unit:
 		self.x_offset = 0		# used for animating unit on the map
 		self.y_offset = 0		# "
 		
+		self.sprite_key = None		# how the unit sprite currently looks
+		
 		self.ranks = 3			# " ranks
 		
 		# find this unit's stats in the list of unit types
@@ -369,8 +1323,18 @@ class Unit:
 		# record of current filled ranks
 		self.current_ranks = self.ranks		
 		
-		# set up unit consoles and sprite
-		self.SetupConsoles()
+		# set up unit consoles and sprite, unless loading from a saved game
+		if consoles:
+			self.SetupConsoles()
+	
+	
+	# unit consoles are not saved with the unit, they are recreated with
+	# SetupConsoles() after loading
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state.pop('stat_console', None)
+		state.pop('portrait', None)
+		return state
 	
 	
 	# select this unit
@@ -387,118 +1351,67 @@ class Unit:
 		self.DrawSprite()
 	
 	
-	# set up consoles for new battle, after loading a game, or after saving a game
+	# set up consoles for new battle or after loading a game
 	# also re-draws sprite
+	# unit consoles are not created if the presenter does not render
 	def SetupConsoles(self):
-		self.portrait = libtcod.console_new(15, 13)
-		self.LoadPortrait()
+		if not presenter.rendering: return
+		self.portrait = GetPortrait(self.portrait_file)
 		self.stat_console = libtcod.console_new(CON_WIDTH-4, STAT_CON_HEIGHT)
 		self.UpdateStatConsole()
-		self.sprite = libtcod.console_new(UNIT_WIDTH, UNIT_HEIGHT)
 		self.DrawSprite()
 	
 	
-	# draw the facing indicator for this unit to the given console
-	def DrawFacing(self, console, x, y, color):
-		# set color to player color
-		libtcod.console_set_default_foreground(console, color)
-		# draw facing indicator characters
-		if self.facing == 0:
-			libtcod.console_put_char(console, x-2, y-2, 30)
-			libtcod.console_put_char(console, x, y-2, 30)
-			libtcod.console_put_char(console, x+2, y-2, 30)
-		elif self.facing == 1:
-			libtcod.console_put_char(console, x+3, y-2, '/')
-			libtcod.console_put_char(console, x+4, y-1, '/')
-			libtcod.console_put_char(console, x+5, y, '/')
-		elif self.facing == 2:
-			libtcod.console_put_char(console, x+3, y+2, '\\')
-			libtcod.console_put_char(console, x+4, y+1, '\\')
-			libtcod.console_put_char(console, x+5, y, '\\')
-		elif self.facing == 3:
-			libtcod.console_put_char(console, x-2, y+2, 31)
-			libtcod.console_put_char(console, x, y+2, 31)
-			libtcod.console_put_char(console, x+2, y+2, 31)
-		elif self.facing == 4:
-			libtcod.console_put_char(console, x-3, y+2, '/')
-			libtcod.console_put_char(console, x-4, y+1, '/')
-			libtcod.console_put_char(console, x-5, y, '/')
-		elif self.facing == 5:
-			libtcod.console_put_char(console, x-3, y-2, '\\')
-			libtcod.console_put_char(console, x-4, y-1, '\\')
-			libtcod.console_put_char(console, x-5, y, '\\')
-		# reset console color
-		libtcod.console_set_default_foreground(console, libtcod.white)
-	
-	
-	# draw or re-draw the unit sprite to its sprite console
-	def DrawSprite(self):
-		libtcod.console_clear(self.sprite)
-		if battle.selected == self:
-			fg = libtcod.white
-		else:
-			if self.player == 0:
-				if self.broken:
-					fg = libtcod.dark_azure
-				else:
-					fg = libtcod.azure
-			else:
-				if self.broken:
-					fg = libtcod.dark_flame
-				else:
-					fg = libtcod.flame
-		libtcod.console_set_default_foreground(self.sprite, fg)
-		
-		# determine if unit is facing up or down
-		up = False
-		if self.facing == 0 or self.facing == 1 or self.facing == 5:
-			up = True
-		
-		# draw ranks from front to back
-		if up:
-			y1 = 2
-			ys = 1
-		else:
-			y1 = 4
-			ys = -1
-		
-		x = int(UNIT_WIDTH/2)
-		
-		# grab each number of fighters in each rank and draw them
-		for rank_pop in self.rank_pop:
-			text = self.unit_char * rank_pop
-			libtcod.console_print_ex(self.sprite, x, y1, libtcod.BKGND_NONE, libtcod.CENTER, text)
-			y1 += ys
-		
-		# draw stats with location based on facing
-		if up:
-			dy = 5
-		else:
-			dy = 1
-		
+	# returns the sprite key for the unit's current state: everything that
+	# changes how its sprite looks, so units that look alike share a sprite
+	def GetSpriteKey(self):
 		if self.melee > 0:
-			text = str(self.melee + self.attack_mod)
+			attack = self.melee + self.attack_mod
 		elif self.ranged > 0:
-			text = str(self.ranged + self.attack_mod)
+			attack = self.ranged + self.attack_mod
 		else:
-			text = '0'
-		text += ' - ' + str(self.defense + self.defense_mod)
-		libtcod.console_print_ex(self.sprite, x, dy, libtcod.BKGND_NONE, libtcod.CENTER, text)
-		
-		# draw broken indicator if applicable
-		if self.broken:
-			libtcod.console_set_default_foreground(self.sprite, libtcod.dark_red)
-			libtcod.console_put_char(self.sprite, x, dy, 'B', flag=libtcod.BKGND_NONE)
-			libtcod.console_set_default_foreground(self.sprite, libtcod.white)
-		
-		# draw facing indicator
-		self.DrawFacing(self.sprite, x, 3, fg)
+			attack = 0
+		return (self.unit_char, self.player, self.facing, tuple(self.rank_pop),
+			self.broken, battle.selected == self, attack,
+			self.defense + self.defense_mod)
+	
+	
+	# update the unit sprite to match its current state
+	# the sprite itself is drawn by GetSprite() when it is needed
+	def DrawSprite(self):
+		if not presenter.rendering: return
+		self.sprite_key = self.GetSpriteKey()
+	
+	
+	# returns the parts of the unit that make up the battle position, used
+	# to hash the battle state
+	def GetStateKey(self):
+		return (self.name, self.player, self.hx, self.hy, self.facing,
+			tuple(self.rank_pop), self.broken, self.ap)
+	
+	
+	# returns the parts of the unit that change during a battle, for the
+	# battle's undo log
+	def GetUndoState(self):
+		return (self.hx, self.hy, self.facing, tuple(self.rank_pop), self.fighters,
+			self.current_ranks, self.broken, self.ap, self.free_attempt,
+			self.attack_mod, self.defense_mod, self.melee_locked)
+	
+	
+	# put back a state returned by GetUndoState()
+	def SetUndoState(self, state):
+		(self.hx, self.hy, self.facing, rank_pop, self.fighters,
+			self.current_ranks, self.broken, self.ap, self.free_attempt,
+			self.attack_mod, self.defense_mod, self.melee_locked) = state
+		self.rank_pop = list(rank_pop)
 	
 	
 	# reset unit for new turn
 	def Reset(self):
+		battle.SaveUnit(self)
 		self.ap = self.max_ap		# replenish action points
 		self.free_attempt = False	# reset break attempt flag
+		battle.UpdateHash(self)
 		self.UpdateStatConsole()
 	
 	
@@ -506,7 +1419,7 @@ class Unit:
 	def DestroyMe(self):
 		Message(self.name + ' has been destroyed!')
 		battle.BreakLocks(self)		# remove self from any melee locks
-		battle.units.remove(self)	# remove self from list of active units
+		battle.RemoveUnit(self)		# remove self from list of active units
 		if battle.selected == self:	# deselect if was selected
 			self.DeselectMe()
 		
@@ -523,6 +1436,7 @@ class Unit:
 	
 	# calculate total active attack and defense modifiers
 	def ApplyMods(self):
+		battle.SaveUnit(self)
 		self.attack_mod = 0
 		# terrain defense bonus
 		self.defense_mod = GetHexFromMap(self.hx, self.hy).defense_mod
@@ -552,33 +1466,27 @@ class Unit:
 	
 	# draw a representation of the unit to the console
 	def DrawMe(self, console):
+		(x, y, w, h) = self.GetSpriteRect()
+		# blit sprite to screen with background alpha
+		libtcod.console_blit(GetSprite(self.sprite_key), 0, 0, w, h, console, x, y, 1.0, 0.0)
+	
+	
+	# returns the screen area covered by the unit sprite as (x, y, w, h)
+	def GetSpriteRect(self):
 		# get top left of location on screen
 		# if we're animating, use the offset location instead
 		if self.x_offset > 0 or self.y_offset > 0:
 			x, y = self.x_offset, self.y_offset
 		else:
 			x, y = Hex2Screen(self.hx, self.hy)
-		# blit sprite to screen with background alpha
-		libtcod.console_blit(self.sprite, 0, 0, UNIT_WIDTH, UNIT_HEIGHT, console, x+3, y+4, 1.0, 0.0)
-
-
-	# load unit portrait and blit to portrait console
-	def LoadPortrait(self):
-		# fill in placeholder if no portrait
-		if self.portrait_file == '':
-			libtcod.console_set_default_background(self.portrait, libtcod.grey)
-			libtcod.console_clear(self.portrait)
-			libtcod.console_print_ex(self.portrait, 7, 4, libtcod.BKGND_NONE, libtcod.CENTER, 'Portrait')
-			libtcod.console_print_ex(self.portrait, 7, 5, libtcod.BKGND_NONE, libtcod.CENTER, 'will go here')
-			return
-		# load portrait from file and blit to portrait console
-		temp = libtcod.image_load(self.portrait_file)
-		libtcod.image_blit_2x(temp, self.portrait, 0, 0)
-		del temp
+		return (x+3, y+4, UNIT_WIDTH, UNIT_HEIGHT)
 
 
 	# update info in stat console
 	def UpdateStatConsole(self):
+		if not presenter.rendering: return
+		if session is not None:
+			session.stat_versions[self] = session.stat_versions.get(self, 0) + 1
 		libtcod.console_clear(self.stat_console)
 		
 		y = 0
@@ -689,7 +1597,9 @@ class Unit:
 	# attempt to spend ap, returns false if not enough remaining
 	def SpendAP(self, ap_cost):
 		if self.ap >= ap_cost:
+			battle.SaveUnit(self)
 			if not FREE_AP: self.ap -= ap_cost
+			battle.UpdateHash(self)
 			self.UpdateStatConsole()
 			return True
 		return False
@@ -715,7 +1625,9 @@ class Unit:
 			Message(self.name + ' is melee locked.')
 			return
 			
+		battle.SaveUnit(self)
 		self.facing = self.GetFacing(self.facing + change)
+		battle.UpdateHash(self)
 		self.DrawSprite()
 		
 
@@ -737,15 +1649,14 @@ class Unit:
 			return
 		
 		# check to see if there's a unit in the destination hex
-		for obj in battle.units:
-			if obj.hx == hx2 and obj.hy == hy2:
-				if obj.player == self.player:
-					# try to initiate unit swap
-					self.UnitSwap(obj)
-					return
-				else:
-					Message('Enemy unit in target hex')
-					return
+		obj = GetUnitInHex(hx2, hy2)
+		if obj is not None:
+			if obj.player == self.player:
+				# try to initiate unit swap
+				self.UnitSwap(obj)
+			else:
+				Message('Enemy unit in target hex')
+			return
 		
 		# get AP cost to move into hex
 		cost = GetMoveCost(self, hx2, hy2)
@@ -756,19 +1667,10 @@ class Unit:
 			return
 		
 		# animate into new hex
-		x1, y1 = Hex2Screen(self.hx, self.hy)
-		x2, y2 = Hex2Screen(hx2, hy2)
-		points = GetLine(x1, y1, x2, y2)
-		for (x, y) in points:
-			self.x_offset = x
-			self.y_offset = y
-			RenderAll()
-		self.x_offset = 0
-		self.y_offset = 0
+		presenter.AnimateMove(self, hx2, hy2)
 		
 		# move into new hex
-		self.hx = hx2
-		self.hy = hy2
+		battle.MoveUnit(self, hx2, hy2)
 		
 		# apply modifiers of new hex location
 		self.ApplyMods()
@@ -795,7 +1697,7 @@ class Unit:
 			return
 		
 		text = 'Attempt position swap with ' + obj.name + '?'
-		if not GetYNWindow(text):
+		if not AskYN(text):
 			Message('Swap canceled')
 			return
 		
@@ -812,16 +1714,20 @@ class Unit:
 		Message('Swap successful!')
 		
 		# swap the units
-		self.hx, obj.hx = obj.hx, self.hx
-		self.hy, obj.hy = obj.hy, self.hy
+		battle.SwapUnits(self, obj)
 		self.SpendAP(cost1)			# also update stat consoles
 		obj.SpendAP(cost2)
 	
 	
 	# attempt to move along a path to a destination
 	# does not spend any AP
-	def MovePath(self, hx2, hy2, freemove=False):
-		path, cost = GetPath(self, self.hx, self.hy, hx2, hy2)
+	# if a ReachMap from the current location is supplied, the path is taken
+	# from it instead of being searched for
+	def MovePath(self, hx2, hy2, freemove=False, reach=None):
+		if reach is not None:
+			path, cost = reach.GetPath(hx2, hy2)
+		else:
+			path, cost = GetPath(self, self.hx, self.hy, hx2, hy2)
 		if cost < 1:
 			Message('Error: No path possible!')
 			return False
@@ -830,25 +1736,17 @@ class Unit:
 				if not self.SpendAP(cost):
 					return False
 			for (hx, hy) in path:
+				battle.SaveUnit(self)
 				self.facing = GetDirToHex(self.hx, self.hy, hx, hy)
 				self.DrawSprite()	# in case we turned
 				
 				# animate into new hex
-				x1, y1 = Hex2Screen(self.hx, self.hy)
-				x2, y2 = Hex2Screen(hx, hy)
-				points = GetLine(x1, y1, x2, y2)
-				for (x, y) in points:
-					self.x_offset = x
-					self.y_offset = y
-					RenderAll()
-				self.x_offset = 0
-				self.y_offset = 0
+				presenter.AnimateMove(self, hx, hy)
 				
 				# move into new hex
-				self.hx = hx
-				self.hy = hy
+				battle.MoveUnit(self, hx, hy)
 				
-			RenderAll()
+			presenter.Render()
 			return True
 	
 	
@@ -856,23 +1754,22 @@ class Unit:
 	def InitAttack(self, hx, hy):
 		if self.broken: return
 		# get the unit in the target hex
-		for obj in battle.units:
-			if obj.hx == hx and obj.hy == hy:
-				# don't target self!
-				if obj == self:
-					return
-				# don't target allies
-				if obj.player == self.player:
-					return
-				
-				# if target is not adjacent or attacker has no melee
-				# attack, do a ranged attack
-				if self.melee < 1 or GetHexDistance(self.hx, self.hy, obj.hx, obj.hy) > 1:
-					self.RangedAttack(obj)
-					return
-				else:
-					self.MeleeAttack(obj)
-					return
+		obj = GetUnitInHex(hx, hy)
+		if obj is None:
+			return
+		# don't target self!
+		if obj == self:
+			return
+		# don't target allies
+		if obj.player == self.player:
+			return
+		
+		# if target is not adjacent or attacker has no melee
+		# attack, do a ranged attack
+		if self.melee < 1 or GetHexDistance(self.hx, self.hy, obj.hx, obj.hy) > 1:
+			self.RangedAttack(obj)
+		else:
+			self.MeleeAttack(obj)
 			
 
 	# start a melee attack on enemy unit
@@ -914,13 +1811,15 @@ class Unit:
 					charge_bonus = True
 		
 		# turn attacker to face target
+		battle.SaveUnit(self)
 		self.facing = GetDirToHex(self.hx, self.hy, obj.hx, obj.hy)
+		battle.UpdateHash(self)
 		self.DrawSprite()
 		
 		# show melee attack message
 		Message(self.name + ' attacks ' + obj.name)
-		RenderAll()
-		libtcod.sys_sleep_milli(400)
+		presenter.Render()
+		presenter.Pause(400)
 		
 		# do attack, get number of hits on enemy, counter flag, and morale test flag
 		hits, counter, def_morale_test = self.Attack(obj, charge=charge_bonus)
@@ -939,8 +1838,8 @@ class Unit:
 		
 		# pause to show casualties
 		if hits > 0 or own_hits > 0:
-			RenderAll()
-			libtcod.sys_sleep_milli(600)
+			presenter.Render()
+			presenter.Pause(600)
 		
 		# do any break tests and remove dead units
 		if hits > 0:
@@ -967,7 +1866,9 @@ class Unit:
 		
 		# if defender is still adjacent to attacker, they may turn to face them
 		if GetHexDistance(self.hx, self.hy, obj.hx, obj.hy) == 1 and turn_to_face:
+			battle.SaveUnit(obj)
 			obj.facing = GetDirToHex(obj.hx, obj.hy, self.hx, self.hy)
+			battle.UpdateHash(obj)
 			obj.DrawSprite()
 	
 	
@@ -998,14 +1899,7 @@ class Unit:
 			half_hits = True
 		
 		# display and check LoS
-		RenderAll()
-		x1, y1 = Hex2Screen(self.hx, self.hy, center=True)
-		x2, y2 = Hex2Screen(obj.hx, obj.hy, center=True)
-		points = GetLine(x1, y1, x2, y2)
-		for (x, y) in points:
-			libtcod.console_set_char_background(0, x, y, libtcod.white, flag=libtcod.BKGND_SET)
-		libtcod.console_flush()
-		libtcod.sys_sleep_milli(600)
+		presenter.ShowLoS(self, obj)
 		
 		if self.CheckLoS(obj):
 			Message('Line of Sight is blocked')
@@ -1019,7 +1913,9 @@ class Unit:
 		Message(self.name + ' does a ranged attack on ' + obj.name)
 		
 		# face target
+		battle.SaveUnit(self)
 		self.facing = GetDirToHex(self.hx, self.hy, obj.hx, obj.hy)
+		battle.UpdateHash(self)
 		self.DrawSprite()
 		
 		# get number of hits, will never return counter since it's a ranged attack
@@ -1029,8 +1925,8 @@ class Unit:
 			obj.TakeHits(hits)
 		
 			# pause to show casualties
-			RenderAll()
-			libtcod.sys_sleep_milli(600)
+			presenter.Render()
+			presenter.Pause(600)
 			
 			# do morale tests and remove dead units
 			obj.UnitCheck()
@@ -1043,124 +1939,16 @@ class Unit:
 			obj.FallBackTest(self)
 	
 	
-	# TODO: LoS will have to be moved out of units because engine will need to
-	# check them sometimes
-	# check LoS between two hexes along a hex spine
-	def CheckHexSpineLoS(self, hx1, hy1, hx2, hy2, degs):
-		
-		# get moves required to build hex line based on angle
-		
-		if degs == 51:
-			moves = [(0,1), (1,0)]
-		elif degs == 0:
-			moves = [(1,1), (0,-1)]
-		elif degs == 310:
-			moves = [(1,0), (-1,-1)]
-		elif degs == 231:
-			moves = [(0,-1), (-1,0)]
-		elif degs == 180:
-			moves = [(-1,-1), (0,1)]
-		elif degs == 130:
-			moves = [(-1,0), (1,1)]
-		else:
-			Message('CheckHexSpineLoS() Error!')
-			return []
-		
-		# start at attacker and step toward target
-		hx, hy = hx1, hy1
-		while hx != hx2 and hy != hy2:
-			# check next pair of hexes
-			(xm, ym) = moves[0]
-			hx += xm
-			hy += ym
-			blocks1 = BlocksLoS(hx, hy, self.player)
-			
-			(xm, ym) = moves[1]
-			hx += xm
-			hy += ym
-			blocks2 = BlocksLoS(hx, hy, self.player)
-			
-			# if both blocked, LoS is blocked
-			if blocks1 and blocks2:
-				return True
-			
-			# step to next hex in line
-			(xm, ym) = moves[0]
-			hx += xm
-			hy += ym
-			
-			# if this is the target hex, LoS is clear
-			if hx == hx2 and hy == hy2:
-				return False
-			
-			# otherwise check this hex, and if it's clear, we can move on to next pair
-			if BlocksLoS(hx, hy, self.player):
-				return True
-		
-		# we shouldn't get here, but if we do, LoS is clear
-		return False
-	
-	
-	# display and check LoS from this unit to the target 
+	# returns True if LoS from this unit to the target is blocked
 	def CheckLoS(self, obj):
-		# get hex path to target
-		x1, y1 = Hex2Screen(self.hx, self.hy, center=True)
-		x2, y2 = Hex2Screen(obj.hx, obj.hy, center=True)
-		
-		# if path is on a hexline, we need to check hexes on both sides of the line
-		# TODO: this might not be accurate enough
-		dx, dy = x2-x1, y2-y1
-		rads = atan2(-dy,dx)
-		rads %= 2*pi
-		degs = int(ceil(degrees(rads)))
-		
-		if degs in [51, 0, 310, 231, 180, 130]:
-			blocked = self.CheckHexSpineLoS(self.hx, self.hy, obj.hx, obj.hy, degs)
-			return blocked
-		else:
-			points = GetLine(x1, y1, x2, y2)
-			LoS = []
-			for (x, y) in points:
-				hx, hy = GetHex(x, y)
-				if (hx, hy) in LoS:
-					continue
-				LoS.append((hx, hy))
-			
-		# check the list of hexes intersected by the line of sight
-		for (hx, hy) in LoS:
-			# ignore attacker's and defender's hex
-			if hx == self.hx and hy == self.hy:
-				continue
-			if hx == obj.hx and hy == obj.hy:
-				continue
-			
-			if BlocksLoS(hx, hy, self.player):
-				return True
-			
-		return False
+		return not battle.HasLoS(self.hx, self.hy, obj.hx, obj.hy)
 	
 	
 	# works out an attack, melee or ranged, on the target and returns number of hits
 	# on the target and hits on the attacker resulting from a counterattack
 	# also returns True if defender has to take a Break test
 	def Attack(self, obj, counter=False, ranged=False, half=False, charge=False):
-		# display combat window
-		libtcod.console_clear(session.battle_console)
-		
-		# names
-		libtcod.console_print(session.battle_console, 2, 1, self.name)
-		libtcod.console_set_default_foreground(session.battle_console, libtcod.red)
-		libtcod.console_print_ex(session.battle_console, BATTLE_CONSOLE_WIDTH/2, 1, 
-			libtcod.BKGND_NONE, libtcod.CENTER, '>> attacking >>')
-		libtcod.console_set_default_foreground(session.battle_console, libtcod.white)
-		libtcod.console_print_ex(session.battle_console, BATTLE_CONSOLE_WIDTH-3, 1, 
-			libtcod.BKGND_NONE, libtcod.RIGHT, obj.name)
-		
-		# portraits
-		libtcod.console_blit(self.portrait, 0, 0, 15, 13, session.battle_console, 1, 3)
-		libtcod.console_blit(obj.portrait, 0, 0, 15, 13, session.battle_console, BATTLE_CONSOLE_WIDTH-16, 3)
-		
-		# calculate and display attack and defense values
+		# calculate attack and defense values
 		if ranged:
 			attack_value = self.ranged + self.attack_mod
 			
@@ -1170,7 +1958,7 @@ class Unit:
 			if dist > 0:
 				attack_value -= dist
 				Message('Ranged attack value at -' + str(dist) + ' for range.')
-				RenderAll()
+				presenter.Render()
 			
 		else:
 			attack_value = self.melee + self.attack_mod
@@ -1193,157 +1981,31 @@ class Unit:
 				Message('Shield Bonus!')  # TEMP
 				defense_value += 1
 		
-		libtcod.console_print(session.battle_console, 18, 3, 'Attack')
-		libtcod.console_print(session.battle_console, 21, 4, str(attack_value))
+		# do attack and defense rolls
+		d1, d2 = Roll2D6()
+		#d1, d2 = 6, 6  # TEMP
+		d3, d4 = Roll2D6()
+		#d3, d4 = 1, 1  # TEMP
 		
-		libtcod.console_print_ex(session.battle_console, BATTLE_CONSOLE_WIDTH-19, 3, 
-			libtcod.BKGND_NONE, libtcod.RIGHT, 'Defense')
-		libtcod.console_print_ex(session.battle_console, BATTLE_CONSOLE_WIDTH-22, 4, 
-			libtcod.BKGND_NONE, libtcod.RIGHT, str(defense_value))
-		
-		# do attack and defense rolls
-		def DisplayDie(x, y, value):
-			libtcod.console_rect(session.battle_console, x, y, 3, 3, True, flag=libtcod.BKGND_SET)
-			
-			if 4 <= value <= 6:
-				libtcod.console_put_char(session.battle_console, x, y, 7)	# top left and bottom right
-				libtcod.console_put_char(session.battle_console, x+2, y+2, 7)
-			if value > 1:
-				libtcod.console_put_char(session.battle_console, x+2, y, 7)	# top right and bottom left
-				libtcod.console_put_char(session.battle_console, x, y+2, 7)
-			if IsOdd(value):
-				libtcod.console_put_char(session.battle_console, x+1, y+1, 7)	# center
-			if value == 6:
-				libtcod.console_put_char(session.battle_console, x, y+1, 7)	# center left and right
-				libtcod.console_put_char(session.battle_console, x+2, y+1, 7)
-			
-		# do a number of rolls for each, displaying each and pausing, the settle on final roll
-		libtcod.console_set_default_foreground(session.battle_console, libtcod.black)
-		libtcod.console_set_default_background(session.battle_console, libtcod.white)
-		ROLLS = 5
-		for r in range(ROLLS):
-			d1, d2 = Roll2D6()
-			#d1, d2 = 6, 6  # TEMP
-			attack_roll = d1+d2
-			d3, d4 = Roll2D6()
-			#d3, d4 = 1, 1  # TEMP
-			defense_roll = d3+d4
-			
-			DisplayDie(18, 10, d1)
-			DisplayDie(22, 10, d2)
-			DisplayDie(BATTLE_CONSOLE_WIDTH-20, 10, d3)
-			DisplayDie(BATTLE_CONSOLE_WIDTH-24, 10, d4)
-			
-			libtcod.console_blit(session.battle_console, 0, 0, BATTLE_CONSOLE_WIDTH, 
-				BATTLE_CONSOLE_HEIGHT, 0, (SCREEN_WIDTH/2)-(BATTLE_CONSOLE_WIDTH/2), 
-				(SCREEN_HEIGHT/2)-(BATTLE_CONSOLE_HEIGHT/2))
-			libtcod.console_flush()
-			libtcod.sys_sleep_milli(80)
-		libtcod.console_set_default_background(session.battle_console, libtcod.black)
-		
-		if attack_roll <= attack_value:
-			att = True
-			text = 'Success!'
-			libtcod.console_set_default_foreground(session.battle_console, libtcod.light_azure)
-		else:
-			att = False
-			text = 'Failed'
-			libtcod.console_set_default_foreground(session.battle_console, libtcod.red)
-		libtcod.console_print_ex(session.battle_console, 22, 14, 
-			libtcod.BKGND_NONE, libtcod.CENTER, text)
-		
-		if defense_roll <= defense_value:
-			dff = True
-			text = 'Success!'
-			libtcod.console_set_default_foreground(session.battle_console, libtcod.light_azure)
-		else:
-			dff = False
-			text = 'Failed'
-			libtcod.console_set_default_foreground(session.battle_console, libtcod.red)
-		libtcod.console_print_ex(session.battle_console, BATTLE_CONSOLE_WIDTH-20, 14, 
-			libtcod.BKGND_NONE, libtcod.CENTER, text)
-		
-		libtcod.console_set_default_foreground(session.battle_console, libtcod.white)
+		# ranged attacks and counterattacks will never trigger a counterattack
+		# units with no melee value and broken units can't counterattack
+		# only allow counterattacks against units in front
+		can_counter = not (ranged or counter or obj.melee < 1 or obj.broken or not obj.IsInFront(self.hx, self.hy))
 		
 		# work out effects
-		morale_check = False
-		# both fail
-		if not att and not dff:
-			text = 'No Effect'
-			hits, counter = 0, False
-		
-		# attack failed but defense succeeded
-		# ranged attacks and counterattacks will never trigger a counterattack
-		# units with no melee value and broken units can't counterattack
-		# only allow counterattacks against units in front
-		elif not att and dff:
-			if ranged or counter or obj.melee < 1 or obj.broken or not obj.IsInFront(self.hx, self.hy):
-				text = 'No Effect'
-				hits, counter = 0, False
-			else:
-				text = 'Counterattack!'
-				hits, counter = 0, True
-		else:
-			# work out by how many points the attack roll succeeded
-			attack_points = attack_value - attack_roll
-			
-			# attack succeeded and defense failed
-			if att and not dff:
-				
-				# work out by how many points the defense roll failed
-				defense_fail = defense_roll - defense_value
-				
-				hits, counter = attack_points + defense_fail + 1, False
-				
-				# apply half hits if any, rounded up, at least one hit
-				if half:
-					hits = int(ceil(hits/2))
-					if hits < 1: hits = 1
-				
-				text = str(hits) + ' Hits'
-				
-				# if defense failed with doubles, and unit is not broken,
-				# morale check needed to avoid falling back
-				if d3 == d4 and not obj.broken:
-					morale_check = True
-				
-			else:
-				# both attack and defense succeeded
-				defense_points = defense_value - defense_roll
-				
-				if attack_points > defense_points:
-					hits, counter = attack_points - defense_points, False
-					# apply half hits if any, rounded up, at least one hit
-					if half:
-						hits = int(ceil(hits/2))
-						if hits < 1: hits = 1
-					text = str(hits) + ' Hits'
-				else:
-					text = 'No Effect'
-					hits, counter = 0, False
-		
-		# display result
-		libtcod.console_print_ex(session.battle_console, BATTLE_CONSOLE_WIDTH/2, 15, 
-			libtcod.BKGND_NONE, libtcod.CENTER, text)
+		att, dff, text, hits, counter, morale_check = ResolveAttack(attack_value,
+			defense_value, (d1, d2, d3, d4), half, can_counter, not obj.broken)
 		
 		# ranged units that take at least one melee hit must fall back
+		footer = None
 		if hits > 0 and self.melee > 0 and obj.ranged > 0:
-			libtcod.console_print_ex(session.battle_console, BATTLE_CONSOLE_WIDTH/2, 16, 
-				libtcod.BKGND_NONE, libtcod.CENTER, 'Defender Falls Back')
+			footer = 'Defender Falls Back'
 		elif morale_check:
-			libtcod.console_print_ex(session.battle_console, BATTLE_CONSOLE_WIDTH/2, 16, 
-				libtcod.BKGND_NONE, libtcod.CENTER, 'Defender Morale Test')
+			footer = 'Defender Morale Test'
 		
-		libtcod.console_print_ex(session.battle_console, BATTLE_CONSOLE_WIDTH/2, 17, 
-			libtcod.BKGND_NONE, libtcod.CENTER, 'Space to Continue')
-		
-		# blit battle console to screen and wait for space
-		libtcod.console_blit(session.battle_console, 0, 0, BATTLE_CONSOLE_WIDTH, 
-				BATTLE_CONSOLE_HEIGHT, 0, (SCREEN_WIDTH/2)-(BATTLE_CONSOLE_WIDTH/2), 
-				(SCREEN_HEIGHT/2)-(BATTLE_CONSOLE_HEIGHT/2))
-		libtcod.console_flush()
-		
-		WaitForSpace()
+		# display the combat window
+		presenter.ShowAttack(self, obj, attack_value, defense_value, (d1, d2, d3, d4),
+			att, dff, text, footer)
 		
 		return hits, counter, morale_check
 		
@@ -1353,11 +2015,13 @@ class Unit:
 		if hits < 1: return
 		Message(self.name + ' suffers ' + str(hits) + ' hits')
 		self.TakeDamage(hits)
+		battle.UpdateHash(self)
 		self.DrawSprite()
 
 
 	# remove a number of fighters from damage
 	def TakeDamage(self, damage):
+		battle.SaveUnit(self)
 		# go through ranks back to front, removing fighters
 		active_ranks = len(self.rank_pop)
 		for r in reversed(range(0, active_ranks)):
@@ -1373,6 +2037,7 @@ class Unit:
 	
 	# check if the unit is dead, and do a morale test of required
 	def UnitCheck(self):
+		battle.SaveUnit(self)
 		# count live fighters
 		self.fighters = 0
 		for rank_pop in self.rank_pop:
@@ -1440,23 +2105,23 @@ class Unit:
 		# try to pick a location closest to most friendlies and furthest
 		# from enemies
 		hx2, hy2 = GetFriendlyHex(hexes, self.player)
-		self.hx = hx2
-		self.hy = hy2
+		battle.MoveUnit(self, hx2, hy2)
 		
 		Message(self.name + ' falls back.')
 		# drain AP in case this was result of a counterattack
+		battle.SaveUnit(self)
 		self.ap = 0
+		battle.UpdateHash(self)
 		
-		RenderAll()
+		presenter.Render()
 		
 		# if there is a pursuit option, prompt enemy player
 		if pursuit_option:
 			if self.player == 1 or self.player == 0: # TEMP
 				text = 'Pursue enemy? (No AP cost)'
-				if GetYNWindow(text):
+				if AskYN(text):
 					# move attacker
-					obj.hx = old_hx
-					obj.hy = old_hy
+					battle.MoveUnit(obj, old_hx, old_hy)
 					# re-establish melee lock
 					battle.CreateMeleeLock(self, obj)
 					
@@ -1486,7 +2151,9 @@ class Unit:
 		
 		# otherwise, unit is broken
 		Message(self.name + ' fails its Break test and is Broken.')
+		battle.SaveUnit(self)
 		self.broken = True
+		battle.UpdateHash(self)
 		self.UpdateStatConsole()
 		self.DrawSprite()
 		
@@ -1527,6 +2194,7 @@ class Unit:
 			return
 		
 		# set flag
+		battle.SaveUnit(self)
 		self.free_attempt = True
 		
 		# count up existing melee locks
@@ -1570,10 +2238,10 @@ class Unit:
 		adjacent_foes = []
 		for (direction, hx, hy) in adjacent_hexes:
 			if direction < 0: continue		# off map
-			for obj2 in battle.units:
-				if obj2.hx == hx and obj2.hy == hy and obj2.player != self.player:
-					if unbroken and obj2.broken: continue
-					adjacent_foes.append(obj2)
+			obj2 = GetUnitInHex(hx, hy)
+			if obj2 is None or obj2.player == self.player: continue
+			if unbroken and obj2.broken: continue
+			adjacent_foes.append(obj2)
 		return adjacent_foes
 	
 	
@@ -1598,18 +2266,17 @@ class Unit:
 				return False
 		
 		# select best target from list
-		top_score = 0
 		attacks = []
 		for obj in targets:
 			# score a hypothetical attack on them
 			score = ScoreAttack(self, obj)
 			#print 'Scored an attack at ' + str(score)
 			attacks.append((score, obj))
-			if score > top_score: top_score = score
+		top_score = max([score for (score, obj) in attacks])
 		
 		# do one of the top scored attacks
 		best_attacks = [obj for (score, obj) in attacks if score == top_score]
-		target = best_attacks[libtcod.random_get_int(0, 0, len(best_attacks)-1)]
+		target = best_attacks[battle.rng.GetInt(0, len(best_attacks)-1)]
 		
 		return target
 
@@ -1638,50 +2305,25 @@ class Unit:
 			# higher scores for lower AP cost to get there, good cover, and adjacent friends
 			# lower scores for adjacent enemies, harder targets, broken targets
 			
-			scored_list = []
-			best_score = 0
-			
-			for obj in battle.units:
-				if obj.player != self.player:
-					hexes = GetOpenAdjacents(self, obj.hx, obj.hy)
-					if len(hexes) == 0:
-						continue
-					for (hx2, hy2) in hexes:
-						path, cost = GetPath(self, self.hx, self.hy, hx2, hy2)
-						# if possible to move there and attack
-						if cost <= self.ap - 1:
-							# calculate location score
-							ap_score = (self.ap - cost) * 30
-							def_score = GetHexFromMap(hx2, hy2).defense_mod * 20
-							
-							attack_score = ScoreAttack(self, obj)
-							score = attack_score + ap_score + def_score
-							
-							# add to list
-							scored_list.append((score, hx2, hy2, obj))
-							if score > best_score:
-								best_score = score
+			# find every hex we could move to and still have 1 AP left to attack
+			reach = ReachMap(self, max_cost=self.ap-1)
+			scored_list = self.AIGetMeleeMoves(reach)
 			
 			# if any moves were possible
 			if len(scored_list) > 0:
 				
 				# TEMP: display moves
-				for (score, hx, hy, obj) in scored_list:
-					x, y = Hex2Screen(hx, hy, center=True)
-					text = str(score)
-					libtcod.console_print_ex(0, x, y, libtcod.BKGND_NONE, libtcod.CENTER, text)
-					x, y = Hex2Screen(obj.hx, obj.hy, center=True)
-					libtcod.console_print_ex(0, x, y, libtcod.BKGND_NONE, libtcod.CENTER, '*')
-					
-				libtcod.console_flush()
-				libtcod.sys_sleep_milli(200)
+				presenter.ShowScores([(score, hx, hy) for (score, hx, hy, obj) in scored_list],
+					[(obj.hx, obj.hy) for (score, hx, hy, obj) in scored_list])
 				
 				# select one of the best actions and do it!
+				best_score = max([score for (score, hx, hy, obj) in scored_list])
 				top_list = [(hx, hy, obj) for (score, hx, hy, obj) in scored_list if score == best_score]
-				(hx, hy, obj) = top_list[libtcod.random_get_int(0, 0, len(top_list)-1)]
+				(hx, hy, obj) = top_list[battle.rng.GetInt(0, len(top_list)-1)]
 				
-				# move
-				self.MovePath(hx, hy)
+				# move, unless we can attack from where we are
+				if hx != self.hx or hy != self.hy:
+					self.MovePath(hx, hy, reach=reach)
 				
 				# attack if possible
 				if self.ap > 0:
@@ -1698,30 +2340,85 @@ class Unit:
 		return True
 	
 	
+	# returns a scored list of (score, hx, hy, target) for every hex in reach
+	# next to an enemy, from which the enemy could be attacked
+	# if target is given, only hexes next to it are scored
+	def AIGetMeleeMoves(self, reach, target=None):
+		scored_list = []
+		for obj in battle.units:
+			if obj.player == self.player: continue
+			if target is not None and obj != target: continue
+			hexes = GetOpenAdjacents(self, obj.hx, obj.hy)
+			for (hx2, hy2) in hexes:
+				cost = reach.GetCost(hx2, hy2)
+				# if possible to move there and attack
+				if cost is not None:
+					# calculate location score
+					ap_score = (self.ap - cost) * 30
+					def_score = GetHexFromMap(hx2, hy2).defense_mod * 20
+					
+					attack_score = ScoreAttack(self, obj, hx2, hy2)
+					score = attack_score + ap_score + def_score
+					
+					# add to list
+					scored_list.append((score, hx2, hy2, obj))
+		return scored_list
+	
+	
+	# act with the unit until it has nothing more to do, as the greedy AI
+	def AIActivate(self):
+		for i in range(20):
+			# make sure unit is still unbroken and alive
+			if self.broken: break
+			if self not in battle.units: break
+			
+			finished = self.AIAction()
+			if finished: break
+	
+	
+	# act with the unit by attacking one target for as long as possible,
+	# moving next to it first for a melee attack
+	def AIAttack(self, obj):
+		for i in range(20):
+			if self.broken or self not in battle.units: return
+			if obj not in battle.units or self.ap < 1: return
+			ap = self.ap
+			if self.melee > 0:
+				if GetHexDistance(self.hx, self.hy, obj.hx, obj.hy) > 1:
+					if self.melee_locked: return
+					reach = ReachMap(self, max_cost=self.ap-1)
+					scored_list = self.AIGetMeleeMoves(reach, target=obj)
+					if len(scored_list) == 0: return
+					best_score = max([score for (score, hx, hy, target) in scored_list])
+					top_list = [(hx, hy) for (score, hx, hy, target) in scored_list if score == best_score]
+					(hx, hy) = top_list[battle.rng.GetInt(0, len(top_list)-1)]
+					self.MovePath(hx, hy, reach=reach)
+				self.MeleeAttack(obj)
+			else:
+				self.RangedAttack(obj)
+			
+			# stop if the attack could not be made
+			if self.ap == ap: return
+	
+	
 	# advance toward enemy and objective locations
 	def AIAdvance(self):
 		# get list of possible destinations
-		max_range = self.ap
-		target_hexes = GetHexesWithin(self.hx, self.hy, max_range)
+		reach = ReachMap(self, max_cost=self.ap)
+		target_hexes = reach.GetDestinations()
 		
+		influence = battle.GetInfluence()
 		scored_list = []
 		top_score = 0
 		for (hx, hy) in target_hexes:
-			if HexIsOccupied(hx, hy): continue
-			score = 0
 			# for melee units, closer to enemies is better
 			# but 2 hexes away is ideal, to make them move to attack
-			for obj in battle.units:
-				if obj.player != self.player:
-					proximity_score = 40 - GetHexDistance(hx, hy, obj.hx, obj.hy)
-					if obj.broken:
-						proximity_score = proximity_score // 2
-					
-					# score terrain
-					#defense_mod = GetHexFromMap(hx, hy).defense_mod
-					#proximity_score += (defense_mod * 5)
-					
-					score += proximity_score
+			# broken enemies count for half as much
+			score = influence.GetProximity(hx, hy, self.player)
+			
+			# score terrain
+			#defense_mod = GetHexFromMap(hx, hy).defense_mod
+			#score += (defense_mod * 5)
 			
 			# add this scored hex to the list
 			scored_list.append((score, hx, hy))
@@ -1731,21 +2428,16 @@ class Unit:
 			# TODO: for ranged units, within 5 hexes but not closer to enemies is better
 		
 		# TEMP: display scores on map
-		for (score, hx, hy) in scored_list:
-			x, y = Hex2Screen(hx, hy, center=True)
-			text = str(score)
-			libtcod.console_print_ex(0, x, y, libtcod.BKGND_NONE, libtcod.CENTER, text)
-		libtcod.console_flush()
-		libtcod.sys_sleep_milli(200)
+		presenter.ShowScores(scored_list)
 		#WaitForSpace()
 		
 		#print 'AIAdvance: Top score is ' + str(top_score)
 		
 		# run down the list by score and try to move there
-		shuffle(scored_list)
+		battle.rng.Shuffle(scored_list)
 		scored_list.sort(key=lambda tup: tup[0], reverse=True)
 		for (score, hx, hy) in scored_list:
-			if self.MovePath(hx, hy):
+			if self.MovePath(hx, hy, reach=reach):
 				return
 		
 		print 'AIAdvance: Could not plot a path to any scored target hex'
@@ -1759,20 +2451,18 @@ class Unit:
 		if len(adjacent_foes) > 0:
 			# find closest hex that has no adjacent enemy platoons
 			# start with adjacent hexes and move out to a max radius of 5 hexes
+			reach = ReachMap(self)
+			influence = battle.GetInfluence()
 			destinations = []
 			for radius in range(1, 6):
 				hexes = GetHexesWithin(self.hx, self.hy, radius, exact=True)
 				for (hx, hy) in hexes:
-					# if it's occupied, skip it
+					# if it's occupied or there's no path to it, skip it
 					if HexIsOccupied(hx, hy): continue
+					if reach.GetCost(hx, hy) is None: continue
 					
-					enemies = 0
-					adjacents = GetAdjacents(hx, hy)
-					for (direction, hx2, hy2) in adjacents:
-						if HexHasUnbrokenEnemy(hx2, hy2, self.player):
-							enemies += 1
-					# no adjacent enemies, add to destination list
-					if enemies == 0:
+					# no adjacent unbroken enemies, add to destination list
+					if influence.GetUnbrokenEnemies(hx, hy, self.player) == 0:
 						destinations.append((hx, hy))
 				if len(destinations) > 0:
 					break
@@ -1782,9 +2472,9 @@ class Unit:
 			if len(destinations) > 0:
 				hx, hy = GetFriendlyHex(destinations, self.player)
 				Message(self.name + ' retreats.')
-				RenderAll()
-				libtcod.sys_sleep_milli(600)
-				self.MovePath(hx, hy, freemove=True)
+				presenter.Render()
+				presenter.Pause(600)
+				self.MovePath(hx, hy, freemove=True, reach=reach)
 				return True
 			else:
 				Message(self.name + ' cannot retreat.')
@@ -1799,24 +2489,190 @@ def SpawnUnit(name, player, hx, hy, facing):
 	# if there was an error with the unit type, return
 	if new_unit.unit_type is None:
 		return None
-	battle.units.append(new_unit)
+	battle.AddUnit(new_unit)
 	return new_unit
 
 
-# returns a score representing the likely success of a given attack
-# TODO: needs improvement
-def ScoreAttack(attacker, defender):
-	if attacker.melee > 0:
-		attack_score = attacker.melee + attacker.attack_mod
-	elif attacker.ranged > 0:
-		attack_score = attacker.ranged + attacker.attack_mod
+# works out the effects of an attack from the attack and defense values and the
+# four dice rolled; can_counter is True if the defender is able to counterattack,
+# and can_morale if it can be forced to take a morale check
+# returns attack and defense success, result text, hits on the defender,
+# counterattack flag, and morale check flag
+def ResolveAttack(attack_value, defense_value, dice, half, can_counter, can_morale):
+	(d1, d2, d3, d4) = dice
+	attack_roll = d1+d2
+	defense_roll = d3+d4
+	
+	att = attack_roll <= attack_value
+	dff = defense_roll <= defense_value
+	
+	morale_check = False
+	# both fail
+	if not att and not dff:
+		text = 'No Effect'
+		hits, counter = 0, False
+	
+	# attack failed but defense succeeded
+	elif not att and dff:
+		if not can_counter:
+			text = 'No Effect'
+			hits, counter = 0, False
+		else:
+			text = 'Counterattack!'
+			hits, counter = 0, True
 	else:
-		# no attack!
-		return -1
+		# work out by how many points the attack roll succeeded
+		attack_points = attack_value - attack_roll
+		
+		# attack succeeded and defense failed
+		if att and not dff:
+			
+			# work out by how many points the defense roll failed
+			defense_fail = defense_roll - defense_value
+			
+			hits, counter = attack_points + defense_fail + 1, False
+			
+			# apply half hits if any, rounded up, at least one hit
+			if half:
+				hits = int(ceil(hits/2))
+				if hits < 1: hits = 1
+			
+			text = str(hits) + ' Hits'
+			
+			# if defense failed with doubles, and unit is not broken,
+			# morale check needed to avoid falling back
+			if d3 == d4 and can_morale:
+				morale_check = True
+			
+		else:
+			# both attack and defense succeeded
+			defense_points = defense_value - defense_roll
+			
+			if attack_points > defense_points:
+				hits, counter = attack_points - defense_points, False
+				# apply half hits if any, rounded up, at least one hit
+				if half:
+					hits = int(ceil(hits/2))
+					if hits < 1: hits = 1
+				text = str(hits) + ' Hits'
+			else:
+				text = 'No Effect'
+				hits, counter = 0, False
+	
+	return att, dff, text, hits, counter, morale_check
+
+
+# returns the exact chance of each possible result of an attack, as a list of
+# (chance, hits, counter, morale_check) over all 1296 rolls of the four dice
+def GetAttackOdds(attack_value, defense_value, half=False, can_counter=False, can_morale=True):
+	# attack values below 2 can never succeed, so they all have the same
+	# results; lower defense values mean more hits, so are kept as they are
+	attack_value = max(attack_value, 1)
+	
+	key = (attack_value, defense_value, half, can_counter, can_morale)
+	if key in attack_odds:
+		return attack_odds[key]
+	
+	# results only depend on the attack total and on the defense total and
+	# whether it was doubles, so only one roll of each kind needs to be resolved
+	attack_rolls = {}
+	defense_rolls = {}
+	for d1 in range(1, 7):
+		for d2 in range(1, 7):
+			attack_rolls[d1+d2] = attack_rolls.get(d1+d2, 0) + 1
+			defense_rolls[(d1+d2, d1 == d2)] = defense_rolls.get((d1+d2, d1 == d2), 0) + 1
+	
+	results = {}
+	for (attack_roll, n1) in attack_rolls.iteritems():
+		d1, d2 = 1, attack_roll - 1
+		for ((defense_roll, doubles), n2) in defense_rolls.iteritems():
+			if doubles:
+				d3, d4 = defense_roll/2, defense_roll/2
+			else:
+				d3 = max(1, defense_roll - 6)
+				d4 = defense_roll - d3
+			result = ResolveAttack(attack_value, defense_value, (d1, d2, d3, d4),
+				half, can_counter, can_morale)[3:]
+			results[result] = results.get(result, 0) + n1 * n2
+	
+	odds = []
+	for ((hits, counter, morale_check), n) in sorted(results.iteritems()):
+		odds.append((float(n) / 1296.0, hits, counter, morale_check))
+	attack_odds[key] = odds
+	return odds
+
+
+# fill the attack odds table for every melee and ranged attack value and every
+# defense value that can come up in play
+# the lowest defense is that of a single rank in a hex with a river, locked in
+# melee with six enemies
+def BuildAttackOdds():
+	lowest_defense = min([unit_type.defense for unit_type in unit_classes]) - 7
+	for attack_value in range(1, 12):
+		for defense_value in range(lowest_defense, 13):
+			for half in [False, True]:
+				for can_counter in [False, True]:
+					for can_morale in [False, True]:
+						GetAttackOdds(attack_value, defense_value, half,
+							can_counter, can_morale)
+
+
+# returns a score for a melee attack by attacker from hx, hy on defender: the
+# expected number of hits on the defender, less the expected number of hits
+# on the attacker from a counterattack, times 100
+def ScoreAttack(attacker, defender, hx=None, hy=None):
+	if hx is None:
+		hx, hy = attacker.hx, attacker.hy
+	
+	attack_value = attacker.melee + attacker.attack_mod
+	
+	# possible charge or polearm bonus for a new melee
+	if not battle.IsMeleeLocked(attacker, defender):
+		if 'Charge' in attacker.special:
+			if GetHexFromMap(defender.hx, defender.hy).defense_mod <= 0 and 'Polearms' not in defender.special:
+				attack_value += 2
+		elif 'Polearms' in attacker.special and defender.unit_class == 'Cavalry':
+			attack_value += 2
+	if attack_value > 11: attack_value = 11
+	
+	defense_value = defender.defense + defender.defense_mod
+	if 'Shields' in defender.special and defender.IsInFront(hx, hy):
+		defense_value += 1
+	
+	can_counter = not (defender.melee < 1 or defender.broken or not defender.IsInFront(hx, hy))
+	
+	# the attacker always turns to face the defender, so a counterattack is
+	# always against its front
+	counter_value = defender.melee + defender.attack_mod
+	if counter_value > 11: counter_value = 11
+	counter_defense = attacker.defense + attacker.defense_mod
+	if 'Shields' in attacker.special:
+		counter_defense += 1
+	
+	expected_hits = 0.0
+	counter_chance = 0.0
+	for (chance, hits, counter, morale_check) in GetAttackOdds(attack_value,
+		defense_value, can_counter=can_counter, can_morale=not defender.broken):
+		expected_hits += chance * min(hits, defender.fighters)
+		if counter:
+			counter_chance += chance
 	
-	defend_score = defender.defense + defender.defense_mod
+	expected_counter_hits = 0.0
+	if counter_chance > 0.0:
+		for (chance, hits, counter, morale_check) in GetAttackOdds(counter_value,
+			counter_defense, can_morale=not attacker.broken):
+			expected_counter_hits += chance * min(hits, attacker.fighters)
 	
-	return int(float(attack_score) / float(defend_score) * 100.0)
+	return int((expected_hits - counter_chance * expected_counter_hits) * 100.0)
+
+
+# returns the Zobrist key for a piece of battle state: a random 64-bit number
+# worked out from the state itself, so that it's the same in every process
+def GetZobristKey(state):
+	z = (hash(state) + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+	z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+	z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+	return z ^ (z >> 31)
 
 
 # prints a message announcing current turn, turn limit, and active player
@@ -1833,7 +2689,7 @@ def IsOdd(num):
 
 # do a 2D6 roll
 def Roll2D6():
-	return libtcod.random_get_int(0, 1, 6), libtcod.random_get_int(0, 1, 6)
+	return battle.rng.GetInt(1, 6), battle.rng.GetInt(1, 6)
 
 
 # add a game message and delete oldest one in queue if necessisary
@@ -1848,9 +2704,10 @@ def Message(new_msg, color=libtcod.white):
 		
 		#add the new line as a tuple, with the text and the color
 		battle.messages.append( (line, color) )
+		battle.message_count += 1
 	
 	# update the message console
-	session.UpdateMsgConsole()
+	presenter.UpdateMessages()
 
 
 # Bresenham's Line Algorithm
@@ -1892,12 +2749,113 @@ def GetLine(x1, y1, x2, y2):
 	return points
 
 
-# returns True if hex blocks ranged attack LoS for given player
-def BlocksLoS(hx, hy, player):
+# check LoS between two hexes along a hex spine
+def CheckHexSpineLoS(hx1, hy1, hx2, hy2, degs):
+	
+	# get moves required to build hex line based on angle
+	
+	if degs == 51:
+		moves = [(0,1), (1,0)]
+	elif degs == 0:
+		moves = [(1,1), (0,-1)]
+	elif degs == 310:
+		moves = [(1,0), (-1,-1)]
+	elif degs == 231:
+		moves = [(0,-1), (-1,0)]
+	elif degs == 180:
+		moves = [(-1,-1), (0,1)]
+	elif degs == 130:
+		moves = [(-1,0), (1,1)]
+	else:
+		print 'CheckHexSpineLoS() Error!'
+		return []
+	
+	# start at attacker and step toward target
+	hx, hy = hx1, hy1
+	while hx != hx2 and hy != hy2:
+		# check next pair of hexes
+		(xm, ym) = moves[0]
+		hx += xm
+		hy += ym
+		blocks1 = BlocksLoS(hx, hy)
+		
+		(xm, ym) = moves[1]
+		hx += xm
+		hy += ym
+		blocks2 = BlocksLoS(hx, hy)
+		
+		# if both blocked, LoS is blocked
+		if blocks1 and blocks2:
+			return True
+		
+		# step to next hex in line
+		(xm, ym) = moves[0]
+		hx += xm
+		hy += ym
+		
+		# if this is the target hex, LoS is clear
+		if hx == hx2 and hy == hy2:
+			return False
+		
+		# otherwise check this hex, and if it's clear, we can move on to next pair
+		if BlocksLoS(hx, hy):
+			return True
+	
+	# we shouldn't get here, but if we do, LoS is clear
+	return False
+
+
+# work out whether LoS between two hexes is blocked by terrain, returns True if
+# blocked
+# this is slow, so is only used to fill the LoS table, see Battle.HasLoS()
+def TraceLoS(hx1, hy1, hx2, hy2):
+	# get hex path to target
+	x1, y1 = Hex2Screen(hx1, hy1, center=True)
+	x2, y2 = Hex2Screen(hx2, hy2, center=True)
+	
+	# if path is on a hexline, we need to check hexes on both sides of the line
+	# TODO: this might not be accurate enough
+	dx, dy = x2-x1, y2-y1
+	rads = atan2(-dy,dx)
+	rads %= 2*pi
+	degs = int(ceil(degrees(rads)))
+	
+	if degs in [51, 0, 310, 231, 180, 130]:
+		blocked = CheckHexSpineLoS(hx1, hy1, hx2, hy2, degs)
+		return blocked
+	else:
+		points = GetLine(x1, y1, x2, y2)
+		LoS = []
+		for (x, y) in points:
+			hx, hy = GetHex(x, y)
+			if (hx, hy) in LoS:
+				continue
+			LoS.append((hx, hy))
+		
+	# check the list of hexes intersected by the line of sight
+	for (hx, hy) in LoS:
+		# ignore attacker's and defender's hex
+		if hx == hx1 and hy == hy1:
+			continue
+		if hx == hx2 and hy == hy2:
+			continue
+		
+		if BlocksLoS(hx, hy):
+			return True
+		
+	return False
+
+
+# returns True if hex blocks ranged attack LoS
+# only terrain blocks LoS, so results are the same for both players
+def BlocksLoS(hx, hy):
 	# see if LoS-blocking terrain is in this hex
 	h = GetHexFromMap(hx, hy)
+	if h is None:
+		return False
 	if h.terrain_type == FOREST:
 		return True
+	return False
 
 
 # get a yes or no input from the player, returns True if yes, otherwise false
@@ -1926,6 +2884,8 @@ def GetYNWindow(text, hex1=None, hex2=None):
 	libtcod.console_print_ex(0, SCREEN_WIDTH/2, y+2, libtcod.BKGND_NONE, libtcod.CENTER, text) 
 	libtcod.console_print_ex(0, SCREEN_WIDTH/2, y+4, libtcod.BKGND_NONE, libtcod.CENTER, '(y/N)')
 	libtcod.console_flush()
+	if session is not None:
+		session.full_redraw = True
 	libtcod.sys_wait_for_event(libtcod.EVENT_KEY_PRESS, key, mouse, True)
 	if chr(key.c) == 'y':
 		return True
@@ -1968,11 +2928,21 @@ def GetHex(x, y):
 # if exact, only returns hexes that exact distance away
 # will only return hexes that are on the map
 def GetHexesWithin(hx, hy, distance, exact=False):
+	if distance < 0:
+		return []
+	if (hx, hy) in battle.hex_map:
+		if exact:
+			return list(battle.topology.GetRing(hx, hy, distance))
+		return list(battle.topology.GetDisk(hx, hy, distance))
+	
 	hexes = []
-	for h in battle.map_hexes:
-		dist = GetHexDistance(hx, hy, h.hx, h.hy)
-		if (exact and dist == distance) or (not exact and dist <= distance):
-			hexes.append((h.hx, h.hy))
+	# step through every hex within range, in the same order as the map hexes
+	for xd in range(-distance, distance+1):
+		for yd in range(max(-distance, xd-distance), min(distance, xd+distance)+1):
+			if exact and GetHexDistance(0, 0, xd, yd) != distance:
+				continue
+			if (hx+xd, hy+yd) in battle.hex_map:
+				hexes.append((hx+xd, hy+yd))
 	return hexes
 
 
@@ -1980,17 +2950,10 @@ def GetHexesWithin(hx, hy, distance, exact=False):
 # and the lowest number of unbroken enemies
 # in case of ties, selects a random one
 def GetFriendlyHex(hexes, player):
+	influence = battle.GetInfluence()
 	hex_list = []
-	for (hx, hy) in hexes:		
-		friends = 0
-		for direction in range(0, 6):
-			hx2, hy2 = GetHexInDir(hx, hy, direction)
-			for obj in battle.units:
-				if obj.hx == hx2 and obj.hy == hy2:
-					if obj.player == player:
-						friends += 1
-					else:
-						friends -= 1
+	for (hx, hy) in hexes:
+		friends = influence.GetSupport(hx, hy, player)
 		hex_list.append((friends, hx, hy))
 	
 	# grab top scoring hexes from list
@@ -1999,25 +2962,27 @@ def GetFriendlyHex(hexes, player):
 	top_list = [(hx, hy) for (score, hx, hy) in hex_list if score == top_score]
 	
 	# return a random top scoring hex
-	(hx, hy) = top_list[libtcod.random_get_int(0, 0, len(top_list)-1)]
+	(hx, hy) = top_list[battle.rng.GetInt(0, len(top_list)-1)]
 	return hx, hy
 
 
+# returns the unit in the given hex, or None if there is none
+def GetUnitInHex(hx, hy):
+	return battle.unit_map.get((hx, hy))
+
+
 # return true if there's a unit in the given hex
 def HexIsOccupied(hx, hy):
-	for obj in battle.units:
-		if obj.hx == hx and obj.hy == hy:
-			return True
-	return False
+	return (hx, hy) in battle.unit_map
 
 
 # returns true if there's an unbroken enemy in the given hex
 # player is the friendly unit's player
 def HexHasUnbrokenEnemy(hx, hy, player):
-	for obj in battle.units:
-		if obj.hx == hx and obj.hy == hy and not obj.broken and obj.player != player:
-			return True
-	return False
+	obj = battle.unit_map.get((hx, hy))
+	if obj is None:
+		return False
+	return not obj.broken and obj.player != player
 
 
 # returns true if there's an enemy unit, or a friendly broken or in-melee unit in the hex
@@ -2069,10 +3034,7 @@ def GetDirToHex(hx1, hy1, hx2, hy2):
 
 # returns a pointer to a given terrain hex based on hex coordinates
 def GetHexFromMap(hx, hy):
-	for h in battle.map_hexes:
-		if h.hx == hx and h.hy == hy:
-			return h
-	return None
+	return battle.hex_map.get((hx, hy))
 
 
 # returns a list of all adjacent hexes, without directions, ignores if not on map
@@ -2080,9 +3042,9 @@ def GetHexFromMap(hx, hy):
 # hexes occupied by obj are included as open hexes
 def GetOpenAdjacents(obj, hx, hy):
 	adjacents = []
-	for direction in range(6):
-		hx2, hy2 = GetHexInDir(hx, hy, direction)
-		if (hx2 == obj.hx and hy2 == obj.hy) or (HexIsOnMap(hx2, hy2) and not HexIsOccupied(hx2, hy2)):
+	for (direction, hx2, hy2) in GetAdjacents(hx, hy):
+		if direction < 0: continue
+		if (hx2 == obj.hx and hy2 == obj.hy) or not HexIsOccupied(hx2, hy2):
 			adjacents.append((hx2, hy2))
 	return adjacents
 
@@ -2090,6 +3052,8 @@ def GetOpenAdjacents(obj, hx, hy):
 # returns a list of all adjacent hexes in directions 0-5
 # if adjacent hex is off map, returns -1, -1, -1 for that direction
 def GetAdjacents(hx, hy):
+	if (hx, hy) in battle.topology.neighbours:
+		return list(battle.topology.neighbours[(hx, hy)])
 	adjacents = []
 	for direction in range(6):
 		hx2, hy2 = GetHexInDir(hx, hy, direction)
@@ -2102,6 +3066,9 @@ def GetAdjacents(hx, hy):
 
 # returns the distance between two hexes
 def GetHexDistance(hx1, hy1, hx2, hy2):
+	distance = battle.topology.distances.get((hx1, hy1, hx2, hy2))
+	if distance is not None:
+		return distance
 	xd = hx2 - hx1
 	yd = hy2 - hy1
 	dd = yd - xd
@@ -2120,113 +3087,163 @@ def GetMoveCost(obj, hx, hy):
 	return h.move_cost
 
 
-# GetPath - based on http://stackoverflow.com/questions/4159331/python-speed-up-an-a-star-pathfinding-algorithm
-# and http://www.policyalmanac.org/games/aStarTutorial.htm
+# GetPath - A* search based on http://www.policyalmanac.org/games/aStarTutorial.htm
 # calculates the path from hx1, hy1 to hx2, hy2 for obj with lowest AP move cost,
 # counting friendly broken or in-melee, and all enemy units, as impassible
 # returns a list of path hexes and total AP move cost 
 def GetPath(obj, hx1, hy1, hx2, hy2):
 	
-	class Node:
-		def __init__(self, hx, hy):
-			self.hx = hx
-			self.hy = hy
-			self.g = 0
-			self.h = 0
-			self.parent = None
-	
 	# if destination contains any unit, it is not accessible, so return an empty list
 	if HexIsOccupied(hx2, hy2):
 		print 'ERROR: GetPath(): target hex ' + str(hx2) + ', ' + str(hy2) + ' is occupied'
 		return [], 0
 	
-	open_list = set()	# contains nodes that may be traversed by the path
-	closed_list = set()	# contains nodes that will be traversed by the path
-	blocked_hexes = set()	# lists hexes that are blocked
-	
-	# build list of blocked hexes: intermediate hexes are only blocked by enemies,
-	# and by friends that are either broken or in melee
-	for obj2 in battle.units:
-		if obj.player != obj2.player or obj2.broken or obj2.melee_locked:
-			blocked_hexes.add((obj2.hx, obj2.hy))
+	blocked_hexes = GetBlockedHexes(obj)
 	
 	# function to calculate the H score of a given location to destination
-	def GetH(hx1, hy1, hx2, hy2):
-		return GetHexDistance(hx1, hy1, hx2, hy2) * 4
-	
-	# retrace a set of nodes and return the best path
-	def RetracePath(end_node):
-		path = []
-		n = end_node
-		done = False
-		while not done:
-			path.append((n.hx, n.hy))
-			if n.parent is None: break	# we've reached the end
-			n = n.parent
-				
-		path.reverse()
-		path.pop(0)		# remove the first tile
-		
-		# return the path and the AP cost of the path
-		return path, end_node.g
-	
-	# create the starting and ending nodes
-	start = Node(hx1, hy1)
-	start.h = GetH(hx1, hy1, hx2, hy2)
-	start.f = start.g + start.h
-	end = Node(hx2, hy2)
-	
-	# add the start node to the open list
-	open_list.add(start)
-
-	# while there are still tiles in the 'potentials' list
-	# added window check for bug testing
-	while open_list and not libtcod.console_is_window_closed():
-		
-		# grab the node with the best F value from the list of open tiles
-		current = sorted(open_list, key=lambda inst:inst.f)[0]
-			
-		# move this tile from the open to the closed list
-		open_list.remove(current)
-		closed_list.add(current)
-		
-		# if we've reached our destination, return the path and cost
-		if current.hx == end.hx and current.hy == end.hy:
-			return RetracePath(current)
+	# no hex costs less than 1 AP to enter, so this never overestimates the
+	# remaining cost and the path found is always the cheapest one
+	def GetH(hx, hy):
+		return GetHexDistance(hx, hy, hx2, hy2)
+	
+	g_scores = {(hx1, hy1): 0}	# lowest AP cost found so far to reach each hex
+	parents = {(hx1, hy1): None}	# previous hex on the lowest cost path to each hex
+	closed_hexes = set()		# hexes whose lowest cost is final
+	
+	# the open list is a heap of (f, h, order, hx, hy) entries, ties in f are
+	# broken by the hex closer to the destination, then by the order in which
+	# the hexes were added
+	# a hex may be on the heap more than once if a cheaper path to it was
+	# found later; the older entries are skipped when they come up
+	order = 0
+	open_list = [(GetH(hx1, hy1), GetH(hx1, hy1), order, hx1, hy1)]
+	
+	while open_list:
+		
+		# grab the hex with the best F value from the open list
+		(f, h, n, hx, hy) = heappop(open_list)
+		if (hx, hy) in closed_hexes: continue
+		closed_hexes.add((hx, hy))
+		g = g_scores[(hx, hy)]
+		
+		# if we've reached our destination, retrace the path and return it
+		# with its AP cost
+		if hx == hx2 and hy == hy2:
+			path = []
+			node = (hx, hy)
+			while parents[node] is not None:
+				path.append(node)
+				node = parents[node]
+			path.reverse()
+			return path, g
 		
 		# add the hexes connected to this one to the open list
-		for direction in range(6):
-			hx, hy = GetHexInDir(current.hx, current.hy, direction)
+		for (direction, hx3, hy3) in battle.topology.neighbours[(hx, hy)]:
 			
 			# ignore hexes off the map
-			if not HexIsOnMap(hx, hy): continue
+			if direction < 0: continue
 			
 			# ignore blocked hexes
-			if (hx, hy) in blocked_hexes: continue
+			if (hx3, hy3) in blocked_hexes: continue
 			
 			# ignore hexes already on closed list
-			if (hx, hy) in [(node.hx, node.hy) for node in closed_list]:
-				continue
+			if (hx3, hy3) in closed_hexes: continue
 			
-			# calculate g value of this node
+			# calculate g value of this hex
 			# TODO: doesn't calculate road bonus properly yet
-			g = GetMoveCost(obj, hx, hy)
+			new_g = g + GetMoveCost(obj, hx3, hy3)
 			
-			# if not in open list, add it
-			if not (hx, hy) in [(node.hx, node.hy) for node in open_list]:
-				# create a new node
-				node = Node(hx, hy)
-				node.g = current.g + g
-				node.h = GetH(hx, hy, end.hx, end.hy)
-				node.f = node.g + node.h
-				node.parent = current
-				open_list.add(node)
+			# add it to the open list if it is new, or if this path to it
+			# is cheaper than the one found before
+			old_g = g_scores.get((hx3, hy3))
+			if old_g is None or new_g < old_g:
+				g_scores[(hx3, hy3)] = new_g
+				parents[(hx3, hy3)] = (hx, hy)
+				h = GetH(hx3, hy3)
+				order += 1
+				heappush(open_list, (new_g + h, h, order, hx3, hy3))
 
 	# if we reach here, no more open tiles!
 	Message('Could not find path!')  # TEMP
 	return [], 0
 
 
+# returns the set of hexes that obj can't move through: intermediate hexes are
+# only blocked by enemies, and by friends that are either broken or in melee
+def GetBlockedHexes(obj):
+	blocked_hexes = set()
+	for obj2 in battle.units:
+		if obj.player != obj2.player or obj2.broken or obj2.melee_locked:
+			blocked_hexes.add((obj2.hx, obj2.hy))
+	return blocked_hexes
+
+
+# reachability map: lowest AP cost paths from a unit's current hex to every hex
+# it could move to, found with a single Dijkstra search that follows the same
+# rules as GetPath
+# if max_cost is given, the search stops at hexes costing more than that
+# only valid until the unit or anything blocking it moves
+class ReachMap:
+	def __init__(self, obj, max_cost=None):
+		self.hx = obj.hx
+		self.hy = obj.hy
+		self.cost = {(obj.hx, obj.hy): 0}	# lowest AP cost to reach each hex
+		self.parent = {(obj.hx, obj.hy): None}	# previous hex on the path to each hex
+		
+		blocked_hexes = GetBlockedHexes(obj)
+		done = set()
+		order = 0
+		open_list = [(0, order, obj.hx, obj.hy)]
+		while open_list:
+			(g, n, hx, hy) = heappop(open_list)
+			if (hx, hy) in done: continue
+			done.add((hx, hy))
+			
+			for (direction, hx2, hy2) in battle.topology.neighbours[(hx, hy)]:
+				if direction < 0: continue
+				if (hx2, hy2) in blocked_hexes: continue
+				if (hx2, hy2) in done: continue
+				
+				new_g = g + GetMoveCost(obj, hx2, hy2)
+				if max_cost is not None and new_g > max_cost: continue
+				
+				old_g = self.cost.get((hx2, hy2))
+				if old_g is None or new_g < old_g:
+					self.cost[(hx2, hy2)] = new_g
+					self.parent[(hx2, hy2)] = (hx, hy)
+					order += 1
+					heappush(open_list, (new_g, order, hx2, hy2))
+	
+	
+	# returns the AP cost to reach the given hex, or None if it can't be reached
+	def GetCost(self, hx, hy):
+		return self.cost.get((hx, hy))
+	
+	
+	# returns a path and AP cost to the given hex, in the same form as GetPath
+	# returns an empty path if the hex can't be reached or is occupied
+	def GetPath(self, hx, hy):
+		if (hx, hy) not in self.cost or HexIsOccupied(hx, hy):
+			return [], 0
+		path = []
+		node = (hx, hy)
+		while self.parent[node] is not None:
+			path.append(node)
+			node = self.parent[node]
+		path.reverse()
+		return path, self.cost[(hx, hy)]
+	
+	
+	# returns a list of all unoccupied hexes that can be reached
+	def GetDestinations(self):
+		hexes = []
+		for (hx, hy) in self.cost:
+			if not HexIsOccupied(hx, hy):
+				hexes.append((hx, hy))
+		hexes.sort()
+		return hexes
+
+
 # select the first unit of active player, or next unit in list
 def SelectNextUnit():
 	
@@ -2255,9 +3272,7 @@ def SelectNextUnit():
 
 # check to see if hex is on map
 def HexIsOnMap(hx, hy):
-	if  0 <= hx <= 12 and 0 <= (hy - (hx//2)) < 8:
-		return True
-	return False
+	return (hx, hy) in battle.hex_map
 
 
 # returns upper left corner of given hex
@@ -2271,50 +3286,73 @@ def Hex2Screen(hx, hy, center=False):
 	return x, y
 
 
+# rows of an ascii hex, as (x offset, text)
+HEX_ROWS = [
+	(3, '|-----|'),
+	(2, '/       \\'),
+	(1, '/         \\'),
+	(0, '|           |'),
+	(1, '\\         /'),
+	(2, '\\       /'),
+	(3, '|-----|')
+	]
+
+
 # function to output an ascii hex, 13 columns x 7 rows, with top left at x, y
-def DrawHex(console, x, y):
-	libtcod.console_print_ex(console, x+3, y, libtcod.BKGND_SET, libtcod.LEFT, '|-----|')
-	libtcod.console_print_ex(console, x+2, y+1, libtcod.BKGND_SET, libtcod.LEFT,  '/       \\')
-	libtcod.console_print_ex(console, x+1, y+2, libtcod.BKGND_SET, libtcod.LEFT,  '/         \\')
-	libtcod.console_print_ex(console, x, y+3, libtcod.BKGND_SET, libtcod.LEFT,  '|           |')
-	libtcod.console_print_ex(console, x+1, y+4, libtcod.BKGND_SET, libtcod.LEFT,  '\\         /')
-	libtcod.console_print_ex(console, x+2, y+5, libtcod.BKGND_SET, libtcod.LEFT,  '\\       /')
-	libtcod.console_print_ex(console, x+3, y+6, libtcod.BKGND_SET, libtcod.LEFT,  '|-----|')
+def DrawHex(console, x, y, flag=libtcod.BKGND_SET):
+	for (dy, (dx, text)) in enumerate(HEX_ROWS):
+		libtcod.console_print_ex(console, x+dx, y+dy, flag, libtcod.LEFT, text)
 
 
+# returns the screen areas, as (x, y, w, h), that make up the terrain inside a hex
+def GetTerrainRects(h):
+	x, y = Hex2Screen(h.hx, h.hy)
+	rects = []
+	for ystep in range(1, 4):
+		rects.append((x+6-ystep, y+1+ystep, 5+(ystep*2), 1))
+	for ystep in range(0, 2):
+		rects.append((x+5-ystep, y+6-ystep, 7+(ystep*2), 1))
+	return rects
+
 
 # draws background color of hex based on terrain type
-def DrawTerrain(console, h):
-	x, y = Hex2Screen(h.hx, h.hy)
+# deco_rng is the random number generator used to place decorations
+def DrawTerrain(console, h, deco_rng):
 	
 	# set background color
 	libtcod.console_set_default_background(console, h.color)
 	
-	for ystep in range(1, 4):
-		libtcod.console_rect(console, x+6-ystep, y+1+ystep, 5+(ystep*2), 1, False, flag=libtcod.BKGND_SET)
-	for ystep in range(0, 2):
-		libtcod.console_rect(console, x+5-ystep, y+6-ystep, 7+(ystep*2), 1, False, flag=libtcod.BKGND_SET)
+	for (x, y, w, h2) in GetTerrainRects(h):
+		libtcod.console_rect(console, x, y, w, h2, False, flag=libtcod.BKGND_SET)
+	
+	libtcod.console_set_default_background(console, libtcod.black)
+	
+	DrawTerrainDecorations(console, h, deco_rng)
+
+
+# draws character decorations for hex based on terrain type
+def DrawTerrainDecorations(console, h, deco_rng):
+	x, y = Hex2Screen(h.hx, h.hy)
 	
-	# draw in character decorations
 	if h.terrain_type == TOWN:
 		libtcod.console_set_default_foreground(console, libtcod.dark_sepia)
 		for house in range(0, 30):
-			if libtcod.random_get_int(0, 1, 3) < 3:
+			if libtcod.random_get_int(deco_rng, 1, 3) < 3:
 				char = 127	# little roof
 			else:
 				char = 254	# box
-			x1 = libtcod.random_get_int(0, x+4, x+12)
-			y1 = libtcod.random_get_int(0, y+2, y+6)
+			x1 = libtcod.random_get_int(deco_rng, x+4, x+12)
+			y1 = libtcod.random_get_int(deco_rng, y+2, y+6)
 			libtcod.console_put_char(console, x1, y1, char, flag=libtcod.BKGND_NONE)
 	
 	elif h.terrain_type == RUINS:
 		libtcod.console_set_default_background(console, ROAD_COLOR)
 		for house in range(0, 12):
-			c = libtcod.random_get_int(0, 100, 190)
+			c = libtcod.random_get_int(deco_rng, 100, 190)
 			libtcod.console_set_default_foreground(console, libtcod.Color(c, c, c))
 			char = 254	# box
-			x1 = libtcod.random_get_int(0, x+4, x+12)
-			y1 = libtcod.random_get_int(0, y+2, y+6)
+			x1 = libtcod.random_get_int(deco_rng, x+4, x+12)
+			y1 = libtcod.random_get_int(deco_rng, y+2, y+6)
 			libtcod.console_put_char(console, x1, y1, char, flag=libtcod.BKGND_SET)
 		
 	
@@ -2323,6 +3361,140 @@ def DrawTerrain(console, h):
 	libtcod.console_set_default_background(console, libtcod.black)
 
 
+# returns a console holding the unit sprite for a sprite key, drawing it if
+# it's not already in the cache
+def GetSprite(key):
+	if key in sprite_cache:
+		# move to the end, so the least recently used sprite is first
+		sprite = sprite_cache.pop(key)
+		sprite_cache[key] = sprite
+		return sprite
+	
+	# remove the least recently used sprite if the cache is full
+	if len(sprite_cache) >= SPRITE_CACHE_SIZE:
+		(old_key, old_sprite) = sprite_cache.popitem(last=False)
+		libtcod.console_delete(old_sprite)
+	
+	sprite = libtcod.console_new(UNIT_WIDTH, UNIT_HEIGHT)
+	PaintSprite(sprite, key)
+	sprite_cache[key] = sprite
+	return sprite
+
+
+# returns a console holding the unit portrait from the given file, loading it
+# the first time it's needed; the console is shared and must not be drawn on
+def GetPortrait(portrait_file):
+	if portrait_file in portrait_cache:
+		return portrait_cache[portrait_file]
+	
+	portrait = libtcod.console_new(15, 13)
+	# fill in placeholder if no portrait
+	if portrait_file == '':
+		libtcod.console_set_default_background(portrait, libtcod.grey)
+		libtcod.console_clear(portrait)
+		libtcod.console_print_ex(portrait, 7, 4, libtcod.BKGND_NONE, libtcod.CENTER, 'Portrait')
+		libtcod.console_print_ex(portrait, 7, 5, libtcod.BKGND_NONE, libtcod.CENTER, 'will go here')
+	else:
+		# load portrait from file and blit to portrait console
+		temp = libtcod.image_load(portrait_file)
+		libtcod.image_blit_2x(temp, portrait, 0, 0)
+		libtcod.image_delete(temp)
+	portrait_cache[portrait_file] = portrait
+	return portrait
+
+
+# draw a unit sprite to the given console
+def PaintSprite(console, key):
+	(unit_char, player, facing, rank_pops, broken, selected, attack, defense) = key
+	libtcod.console_clear(console)
+	if selected:
+		fg = libtcod.white
+	else:
+		if player == 0:
+			if broken:
+				fg = libtcod.dark_azure
+			else:
+				fg = libtcod.azure
+		else:
+			if broken:
+				fg = libtcod.dark_flame
+			else:
+				fg = libtcod.flame
+	libtcod.console_set_default_foreground(console, fg)
+	
+	# determine if unit is facing up or down
+	up = False
+	if facing == 0 or facing == 1 or facing == 5:
+		up = True
+	
+	# draw ranks from front to back
+	if up:
+		y1 = 2
+		ys = 1
+	else:
+		y1 = 4
+		ys = -1
+	
+	x = int(UNIT_WIDTH/2)
+	
+	# grab each number of fighters in each rank and draw them
+	for rank_pop in rank_pops:
+		text = unit_char * rank_pop
+		libtcod.console_print_ex(console, x, y1, libtcod.BKGND_NONE, libtcod.CENTER, text)
+		y1 += ys
+	
+	# draw stats with location based on facing
+	if up:
+		dy = 5
+	else:
+		dy = 1
+	
+	text = str(attack) + ' - ' + str(defense)
+	libtcod.console_print_ex(console, x, dy, libtcod.BKGND_NONE, libtcod.CENTER, text)
+	
+	# draw broken indicator if applicable
+	if broken:
+		libtcod.console_set_default_foreground(console, libtcod.dark_red)
+		libtcod.console_put_char(console, x, dy, 'B', flag=libtcod.BKGND_NONE)
+		libtcod.console_set_default_foreground(console, libtcod.white)
+	
+	# draw facing indicator
+	DrawFacing(console, facing, x, 3, fg)
+
+
+# draw a unit facing indicator to the given console
+def DrawFacing(console, facing, x, y, color):
+	# set color to player color
+	libtcod.console_set_default_foreground(console, color)
+	# draw facing indicator characters
+	if facing == 0:
+		libtcod.console_put_char(console, x-2, y-2, 30)
+		libtcod.console_put_char(console, x, y-2, 30)
+		libtcod.console_put_char(console, x+2, y-2, 30)
+	elif facing == 1:
+		libtcod.console_put_char(console, x+3, y-2, '/')
+		libtcod.console_put_char(console, x+4, y-1, '/')
+		libtcod.console_put_char(console, x+5, y, '/')
+	elif facing == 2:
+		libtcod.console_put_char(console, x+3, y+2, '\\')
+		libtcod.console_put_char(console, x+4, y+1, '\\')
+		libtcod.console_put_char(console, x+5, y, '\\')
+	elif facing == 3:
+		libtcod.console_put_char(console, x-2, y+2, 31)
+		libtcod.console_put_char(console, x, y+2, 31)
+		libtcod.console_put_char(console, x+2, y+2, 31)
+	elif facing == 4:
+		libtcod.console_put_char(console, x-3, y+2, '/')
+		libtcod.console_put_char(console, x-4, y+1, '/')
+		libtcod.console_put_char(console, x-5, y, '/')
+	elif facing == 5:
+		libtcod.console_put_char(console, x-3, y-2, '\\')
+		libtcod.console_put_char(console, x-4, y-1, '\\')
+		libtcod.console_put_char(console, x-5, y, '\\')
+	# reset console color
+	libtcod.console_set_default_foreground(console, libtcod.white)
+
+
 # draws an HP-style bar to the given console
 def DrawBar(console, a, b, color1, color2, x, y, w):
 	libtcod.console_set_default_background(console, color2)
@@ -2380,7 +3552,7 @@ def GenerateMap():
 	
 	# randomly turn one hexside clockwise or counterclockwise
 	def TurnDir(current_dir):
-		if libtcod.random_get_int(0, 0, 1) == 0:
+		if battle.rng.GetInt(0, 1) == 0:
 			current_dir -= 1
 		else:
 			current_dir += 1
@@ -2398,7 +3570,7 @@ def GenerateMap():
 		
 		# if this is the first road on the map, pick a random edge hex and draw in from there
 		if len(battle.roads) == 0:
-			(hx, hy) = EDGE_HEXES[libtcod.random_get_int(0, 0, len(EDGE_HEXES)-1)]
+			(hx, hy) = EDGE_HEXES[battle.rng.GetInt(0, len(EDGE_HEXES)-1)]
 			
 			# start direction is toward center of map
 			y_row = hy - (hx//2)
@@ -2426,14 +3598,14 @@ def GenerateMap():
 			for h in battle.map_hexes:
 				if h.road:
 					road_hexes.append((h.hx, h.hy))
-			(hx, hy) = road_hexes[libtcod.random_get_int(0, 0, len(road_hexes)-1)]
+			(hx, hy) = road_hexes[battle.rng.GetInt(0, len(road_hexes)-1)]
 			
 			# pick a random direction
 			road_dir = -1
 			
 			# get list of adjacent hexes and shuffle it
 			adjacents = GetAdjacents(hx, hy)
-			shuffle(adjacents)
+			battle.rng.Shuffle(adjacents)
 			
 			# try to find one that's on the map and not a road hex
 			for direction, hx2, hy2 in adjacents:
@@ -2455,7 +3627,7 @@ def GenerateMap():
 			
 			# chance of turning direction if we didn't just start a new segment
 			if turns < MAX_TURNS and hx != hx1 and hy != hy1:
-				if libtcod.random_get_int(0, 1, 100) <= TURN_CHANCE:
+				if battle.rng.GetInt(1, 100) <= TURN_CHANCE:
 					turns += 1
 					
 					# add current segment
@@ -2500,7 +3672,7 @@ def GenerateMap():
 						adjacent_roads += 1
 				# check road total
 				if adjacent_roads > 2:
-					if force_town or libtcod.random_get_int(0, 1, 100) <= TOWN_CHANCE:
+					if force_town or battle.rng.GetInt(1, 100) <= TOWN_CHANCE:
 						h.SetTerrain(TOWN)
 						h.landmark_name = 'Fooberg'	# TODO random names
 						return
@@ -2510,14 +3682,15 @@ def GenerateMap():
 	for hx in range(0, 13):
 		ystart = hx//2
 		for hy in range(ystart, ystart + 8):
-			battle.map_hexes.append(Hex(hx, hy, OPEN_GROUND))
+			battle.AddHex(Hex(hx, hy, OPEN_GROUND))
+	battle.BuildTopology()
 	
 	# random map generation
 	
 	# Road Network
 	
 	# determine how many roads the map will have: 0, 0, 1, 2, 3
-	num_roads = libtcod.random_get_int(0, 0, 4)
+	num_roads = battle.rng.GetInt(0, 4)
 	if num_roads > 0: num_roads -= 1
 	num_roads = 3  # TEMP
 	
@@ -2535,7 +3708,8 @@ def GenerateTestMap():
 	for hx in range(0, 13):
 		ystart = hx//2
 		for hy in range(ystart, ystart + 8):
-			battle.map_hexes.append(Hex(hx, hy, OPEN_GROUND))
+			battle.AddHex(Hex(hx, hy, OPEN_GROUND))
+	battle.BuildTopology()
 	
 	# create the town
 	h = GetHexFromMap(3, 4)
@@ -2580,6 +3754,9 @@ def GenerateTestMap():
 # paint map terrain to map console
 def PaintMap():
 	
+	# the whole map will need to be redrawn to the screen
+	session.full_redraw = True
+	
 	def PaintPath(hx1, hy1, hx2, hy2, path_type):
 		# get the line path
 		x1, y1 = Hex2Screen(hx1, hy1, center=True)
@@ -2597,9 +3774,44 @@ def PaintMap():
 			libtcod.console_rect(session.map_console, x-((size-1)//2), y-((size-1)//2), size, size-1, False, flag=libtcod.BKGND_SET)
 		libtcod.console_set_default_background(session.map_console, libtcod.black)
 	
+	# if this map has been painted before, copy it from the cache
+	map_hash = battle.GetMapHash()
+	if map_hash in terrain_cache:
+		libtcod.console_blit(terrain_cache[map_hash], 0, 0, MAP_WIDTH, MAP_HEIGHT,
+			session.map_console, 0, 0)
+		return
+	
 	# clear map console
 	libtcod.console_clear(session.map_console)
 	
+	# terrain decorations are placed the same way every time this map is painted
+	deco_rng = libtcod.random_new_from_seed(battle.map_seed)
+	if numpy is not None:
+		PaintMapBackground(deco_rng)
+	else:
+		PaintMapTerrain(deco_rng)
+	libtcod.random_delete(deco_rng)
+	
+	# draw rivers
+	for (hx1, hy1, hx2, hy2) in battle.rivers:
+		PaintPath(hx1, hy1, hx2, hy2, 'river')
+	
+	# draw roads
+	for (hx1, hy1, hx2, hy2) in battle.roads:
+		PaintPath(hx1, hy1, hx2, hy2, 'road')
+	
+	# add a copy to the cache, removing the oldest if it's full
+	if len(terrain_cache) >= TERRAIN_CACHE_SIZE:
+		(old_hash, old_console) = terrain_cache.popitem(last=False)
+		libtcod.console_delete(old_console)
+	cached = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+	libtcod.console_blit(session.map_console, 0, 0, MAP_WIDTH, MAP_HEIGHT, cached, 0, 0)
+	terrain_cache[map_hash] = cached
+
+
+# paint hex grid and terrain to the map console, one cell at a time
+def PaintMapTerrain(deco_rng):
+	
 	# draw hex grid with open ground background
 	libtcod.console_set_default_background(session.map_console, OPEN_GROUND_COLOR)
 	libtcod.console_set_default_foreground(session.map_console, libtcod.black)
@@ -2614,7 +3826,7 @@ def PaintMap():
 	
 	# draw terrain to map
 	for h in battle.map_hexes:
-		DrawTerrain(session.map_console, h)
+		DrawTerrain(session.map_console, h, deco_rng)
 	
 	# fill in terrain gaps, skipping outer edge
 	for x in range(1, MAP_WIDTH-1):
@@ -2628,14 +3840,77 @@ def PaintMap():
 			col2 = libtcod.console_get_char_background(session.map_console, x, y+2)
 			if col1 == col2 == FOREST_COLOR:
 				libtcod.console_set_char_background(session.map_console, x, y, col1, flag=libtcod.BKGND_SET)		
+
+
+# paint hex grid and terrain to the map console, with the same results as
+# PaintMapTerrain(); background colours are worked out with NumPy and
+# filled in with a single call
+def PaintMapBackground(deco_rng):
 	
-	# draw rivers
-	for (hx1, hy1, hx2, hy2) in battle.rivers:
-		PaintPath(hx1, hy1, hx2, hy2, 'river')
+	# background colour planes, indexed by [y, x]
+	planes = numpy.zeros((3, MAP_HEIGHT, MAP_WIDTH), dtype=numpy.int_)
 	
-	# draw roads
-	for (hx1, hy1, hx2, hy2) in battle.roads:
-		PaintPath(hx1, hy1, hx2, hy2, 'road')
+	def PaintRect(x, y, w, h, col):
+		x1, y1 = max(x, 0), max(y, 0)
+		x2, y2 = min(x+w, MAP_WIDTH), min(y+h, MAP_HEIGHT)
+		if x2 <= x1 or y2 <= y1: return
+		planes[:, y1:y2, x1:x2] = numpy.array([col.r, col.g, col.b]).reshape(3, 1, 1)
+	
+	# hex grid with open ground background
+	for x in range(13):
+		offset = 0
+		if IsOdd(x):
+			offset = 3
+		for y in range (8):
+			for (dy, (dx, text)) in enumerate(HEX_ROWS):
+				PaintRect((x*9)+1+dx, (y*6)+1+offset+dy, len(text), 1, OPEN_GROUND_COLOR)
+	
+	# terrain
+	for h in battle.map_hexes:
+		for (x, y, w, h2) in GetTerrainRects(h):
+			PaintRect(x, y, w, h2, h.color)
+	
+	# fill in terrain gaps, skipping outer edge: a cell becomes forest if the
+	# cell to its left and the cell two to its right are forest, or the cell
+	# above and the cell two below; filled cells count as forest for the
+	# cells to their right and below them, so repeat until nothing changes
+	forest = ((planes[0] == FOREST_COLOR.r) & (planes[1] == FOREST_COLOR.g) &
+		(planes[2] == FOREST_COLOR.b))
+	right2 = numpy.zeros_like(forest)
+	right2[:, :-2] = forest[:, 2:]
+	below2 = numpy.zeros_like(forest)
+	below2[:-2, :] = forest[2:, :]
+	inside = numpy.zeros_like(forest)
+	inside[1:-1, 1:-1] = True
+	
+	filled = forest
+	while True:
+		left = numpy.zeros_like(forest)
+		left[:, 1:] = filled[:, :-1]
+		above = numpy.zeros_like(forest)
+		above[1:, :] = filled[:-1, :]
+		new_filled = forest | (inside & ((left & right2) | (above & below2)))
+		if (new_filled == filled).all():
+			break
+		filled = new_filled
+	for (plane, value) in zip(planes, [FOREST_COLOR.r, FOREST_COLOR.g, FOREST_COLOR.b]):
+		plane[filled] = value
+	
+	libtcod.console_fill_background(session.map_console, planes[0].flatten(),
+		planes[1].flatten(), planes[2].flatten())
+	
+	# draw hex grid and terrain characters over the background
+	libtcod.console_set_default_foreground(session.map_console, libtcod.black)
+	for x in range(13):
+		offset = 0
+		if IsOdd(x):
+			offset = 3
+		for y in range (8):
+			DrawHex(session.map_console, (x*9)+1, (y*6)+1+offset, flag=libtcod.BKGND_NONE)
+	libtcod.console_set_default_foreground(session.map_console, libtcod.white)
+	
+	for h in battle.map_hexes:
+		DrawTerrainDecorations(session.map_console, h, deco_rng)
 
 
 ################################################################################
@@ -2643,6 +3918,75 @@ def PaintMap():
 ################################################################################
 
 
+# carry out a command and record it in the battle's commands
+# commands are tuples of a name and numbers: ('end',) ends the player turn,
+# ('ai',) plays an AI turn, and the rest are unit actions, with the hex of the
+# unit taking the action: ('facing', hx, hy, change), ('forward', hx, hy),
+# ('path', hx, hy, hx2, hy2), ('attack', hx, hy, hx2, hy2), ('free', hx, hy)
+# a searched AI turn gives one AI command for each unit: ('ai_unit', hx, hy)
+# acts as the greedy AI, ('ai_advance', hx, hy) advances, and
+# ('ai_attack', hx, hy, hx2, hy2) attacks one target
+def DoCommand(command):
+	name = command[0]
+	
+	# a searched AI turn depends on how long the search ran for, so the unit
+	# commands of the plan it found are recorded instead
+	if name == 'ai' and replay_commands is None and search_ai is not None:
+		if battle.active_player in search_ai.players:
+			DoSearchTurn()
+			return
+	
+	battle.commands.append(command)
+	if name == 'end':
+		NextPlayerTurn()
+		return
+	if name == 'ai':
+		DoAITurn()
+		return
+	
+	obj = GetUnitInHex(command[1], command[2])
+	if obj is None:
+		print 'ERROR: No unit for command: ' + str(command)
+		return
+	if name == 'facing':
+		obj.ChangeFacing(command[3])
+	elif name == 'forward':
+		obj.MoveForward()
+	elif name == 'path':
+		obj.MovePath(command[3], command[4])
+	elif name == 'attack':
+		obj.InitAttack(command[3], command[4])
+	elif name == 'free':
+		obj.FreeAttempt()
+	elif name in ['ai_unit', 'ai_advance', 'ai_attack']:
+		obj.SelectMe()
+		presenter.Render()
+		if name == 'ai_unit':
+			obj.AIActivate()
+		elif name == 'ai_advance':
+			obj.AIAdvance()
+		else:
+			target = GetUnitInHex(command[3], command[4])
+			if target is not None:
+				obj.AIAttack(target)
+	else:
+		print 'ERROR: Unknown command: ' + str(command)
+
+
+# ask the player a yes or no question during a command, and record the answer
+# in the battle's commands as ('answer', 0 or 1)
+# when a replay is being played, the recorded answer is given instead
+def AskYN(text):
+	if replay_commands is not None:
+		answer = False
+		if len(replay_commands) > 0 and replay_commands[0][0] == 'answer':
+			answer = replay_commands.popleft()[1] == 1
+	else:
+		answer = presenter.GetYN(text)
+	battle.commands.append(('answer', int(answer)))
+	return answer
+
+
 # allow AI to act
 def DoAITurn():
 	# get list of active units
@@ -2652,26 +3996,18 @@ def DoAITurn():
 			my_units.append(obj)
 	
 	# TEMP shuffle list
-	shuffle(my_units)
+	battle.rng.Shuffle(my_units)
 	
 	# go through each unit and act with it
 	for obj in my_units:
 		
 		# select this unit
 		obj.SelectMe()
-		RenderAll()
+		presenter.Render()
 		
 		# while we still have AP remaining, and we haven't received a stop
 		# result from AIAction, keep acting with this unit
-		
-		# TEMP
-		for i in range(20):
-			# make sure unit is still unbroken and alive
-			if obj.broken: break
-			if obj not in battle.units: break
-			
-			finished = obj.AIAction()
-			if finished: break
+		obj.AIActivate()
 		
 	Message('DEBUG: AI Done!')
 
@@ -2684,6 +4020,9 @@ def NextPlayerTurn():
 	else:
 		battle.active_player = 1
 	
+	# the influence map is worked out afresh each turn
+	battle.ClearInfluence()
+	
 	# reset units for newly active player
 	for obj in battle.units:
 		if obj.player == battle.active_player:
@@ -2692,7 +4031,6 @@ def NextPlayerTurn():
 	if battle.selected is not None:
 		battle.selected.DeselectMe()
 	
-	SaveGame()
 	DisplayTurnInfo()
 	
 	# do retreat movets for broken units
@@ -2703,40 +4041,152 @@ def NextPlayerTurn():
 				d1, d2 = Roll2D6()
 				if d1 + d2 <= obj.morale:
 					Message(obj.name + ' passes its Morale test and is no longer Broken.')
+					battle.SaveUnit(obj)
 					obj.broken = False
+					battle.UpdateHash(obj)
 					obj.DrawSprite()
 				else:
 					Message(obj.name + ' did not pass its Morale test and is still Broken.')
 	
-	RenderAll()
+	# only interactive sessions are autosaved, not replays; saving once the
+	# automatic start of turn actions are done means that playing on from a
+	# loaded game goes the same way as playing on without loading
+	if session is not None and replay_commands is None:
+		SaveGame()
+	
+	presenter.Render()
+
+
+# returns True if two screen areas, given as (x, y, w, h), overlap
+def RectsOverlap(r1, r2):
+	(x1, y1, w1, h1) = r1
+	(x2, y2, w2, h2) = r2
+	return x1 < x2 + w2 and x2 < x1 + w1 and y1 < y2 + h2 and y2 < y1 + h1
+
+
+# returns a screen area clipped to the visible part of the map, or None if
+# none of it is visible
+def ClipToMap(rect):
+	(x, y, w, h) = rect
+	x1, y1 = max(x, 0), max(y, 3)
+	x2, y2 = min(x+w, SCREEN_WIDTH-CON_WIDTH), min(y+h, SCREEN_HEIGHT)
+	if x2 <= x1 or y2 <= y1:
+		return None
+	return (x1, y1, x2-x1, y2-y1)
 
 
 # Main rendering function, draws everything to the main console
+# only redraws and blits to the screen the parts that have changed since the
+# last call, unless session.full_redraw has been set
 def RenderAll():
-	# clear the master console
-	libtcod.console_clear(con)
 	
-	# draw menu bar
-	libtcod.console_hline(con, 1, 0, 70)
-	libtcod.console_print(con, 1, 1, '|  ESC - Game    |  F1 - Help    |  F2 - Scenario    |  F3 - Army    |')
-	libtcod.console_hline(con, 0, 2, SCREEN_WIDTH-CON_WIDTH)
+	full = session.full_redraw
+	session.full_redraw = False
 	
-	# blit map console to the master console
-	libtcod.console_blit(session.map_console, 0, 0, MAP_WIDTH, MAP_HEIGHT, con, 0, 3)
+	# screen areas to be blitted to the root console
+	dirty_rects = []
 	
-	# draw any units
-	for unit in battle.units:
-		unit.DrawMe(con)
+	if full:
+		# clear the master console
+		libtcod.console_clear(con)
+		
+		# draw menu bar
+		libtcod.console_hline(con, 1, 0, 70)
+		libtcod.console_print(con, 1, 1, '|  ESC - Game    |  F1 - Help    |  F2 - Scenario    |  F3 - Army    |')
+		libtcod.console_hline(con, 0, 2, SCREEN_WIDTH-CON_WIDTH)
+		
+		session.drawn_units = {}
+		session.drawn_locks = []
+		session.drawn_panel = None
+		map_rects = [ClipToMap((0, 3, MAP_WIDTH, MAP_HEIGHT))]
+	else:
+		map_rects = []
 	
-	# display melee locks
-	libtcod.console_set_default_foreground(con, libtcod.red)
+	# find any units that have moved or changed since last drawn
+	drawn_units = {}
+	for unit in battle.units:
+		drawn_units[unit] = (unit.GetSpriteRect(), unit.sprite_key)
+	for unit in set(drawn_units) | set(session.drawn_units):
+		old = session.drawn_units.get(unit)
+		new = drawn_units.get(unit)
+		if old == new: continue
+		for drawn in [old, new]:
+			if drawn is not None:
+				map_rects.append(ClipToMap(drawn[0]))
+	
+	# find melee lock markers
+	drawn_locks = []
 	for (obj1, obj2) in battle.melee_locks:
 		x1, y1 = Hex2Screen(obj1.hx, obj1.hy, center=True)
 		x2, y2 = Hex2Screen(obj2.hx, obj2.hy, center=True)
-		x, y = int((x1+x2)/2), int((y1+y2)/2)+3
-		libtcod.console_put_char(con, x, y, 21, libtcod.BKGND_NONE) 
+		drawn_locks.append((int((x1+x2)/2), int((y1+y2)/2)+3))
+	if drawn_locks != session.drawn_locks:
+		for (x, y) in session.drawn_locks + drawn_locks:
+			map_rects.append(ClipToMap((x, y, 1, 1)))
+	
+	map_rects = [rect for rect in map_rects if rect is not None]
+	
+	# any unit that overlaps an area to be redrawn must be redrawn in full,
+	# which may overlap other units in turn
+	redraw_units = []
+	changed = True
+	while changed:
+		changed = False
+		for unit in battle.units:
+			if unit in redraw_units: continue
+			(rect, version) = drawn_units[unit]
+			for dirty in map_rects:
+				if RectsOverlap(rect, dirty):
+					redraw_units.append(unit)
+					clipped = ClipToMap(rect)
+					if clipped is not None:
+						map_rects.append(clipped)
+					changed = True
+					break
+	
+	# redraw the map, units, and melee locks in the changed areas
+	for (x, y, w, h) in map_rects:
+		libtcod.console_blit(session.map_console, x, y-3, w, h, con, x, y)
+	for unit in battle.units:
+		if unit in redraw_units:
+			unit.DrawMe(con)
+	libtcod.console_set_default_foreground(con, libtcod.red)
+	for (x, y) in drawn_locks:
+		for dirty in map_rects:
+			if RectsOverlap((x, y, 1, 1), dirty):
+				libtcod.console_put_char(con, x, y, 21, libtcod.BKGND_NONE)
+				break
 	libtcod.console_set_default_foreground(con, libtcod.white)
 	
+	session.drawn_units = drawn_units
+	session.drawn_locks = drawn_locks
+	dirty_rects.extend(map_rects)
+	
+	# redraw the info panel if anything shown in it has changed
+	if battle.selected is not None:
+		selected_version = session.stat_versions.get(battle.selected, 0)
+	else:
+		selected_version = 0
+	drawn_panel = (battle.current_turn, battle.turn_limit, battle.player0_score,
+		battle.player1_score, battle.active_player, session.terrain_version,
+		session.msg_version, battle.selected, selected_version)
+	if drawn_panel != session.drawn_panel:
+		RenderPanel()
+		session.drawn_panel = drawn_panel
+		dirty_rects.append((SCREEN_WIDTH-CON_WIDTH, 0, CON_WIDTH, SCREEN_HEIGHT))
+	
+	# finally, blit the changed parts of the master console to the screen
+	if full:
+		libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
+	else:
+		for (x, y, w, h) in dirty_rects:
+			libtcod.console_blit(con, x, y, w, h, 0, x, y)
+	libtcod.console_flush()
+
+
+# draw the info panel on the right side of the main console
+def RenderPanel():
+	
 	y = 0
 	
 	# draw info window frame
@@ -2779,10 +4229,6 @@ def RenderAll():
 	y = SCREEN_HEIGHT - MSG_CON_HEIGHT - 1
 	libtcod.console_hline(con, SCREEN_WIDTH-CON_WIDTH+1, y-1, CON_WIDTH-2)
 	libtcod.console_blit(session.msg_con, 0, 0, CON_WIDTH-4, MSG_CON_HEIGHT, con, SCREEN_WIDTH-CON_WIDTH+2, y)
-	
-	# finally, blit the master console to the screen
-	libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
-	libtcod.console_flush()
 
 
 # get user input
@@ -2825,10 +4271,9 @@ def HandleInput():
 				battle.selected.DeselectMe()
 			
 			# select any unit in this hex
-			for obj in battle.units:
-				if obj.hx == hx and obj.hy == hy:
-					obj.SelectMe()
-					break
+			obj = GetUnitInHex(hx, hy)
+			if obj is not None:
+				obj.SelectMe()
 			RenderAll()
 			return None
 		
@@ -2844,7 +4289,8 @@ def HandleInput():
 					# see if this hex is occupied
 					if HexIsOccupied(hx, hy):
 						# try to init an attack against this hex
-						battle.selected.InitAttack(hx, hy)
+						obj = battle.selected
+						DoCommand(('attack', obj.hx, obj.hy, hx, hy))
 					else:
 						# if not occupied, plot a path to it
 						pass
@@ -2857,22 +4303,24 @@ def HandleInput():
 		choice = InGameMenu()
 		if choice:
 			return 'exit'
+		session.full_redraw = True
 		RenderAll()
 	
 	# scenario screen
 	elif key.vk == libtcod.KEY_F2:
 		ScenarioMenu()
+		session.full_redraw = True
 		RenderAll()
 	
 	elif key.vk == libtcod.KEY_ENTER:
 		# end player turn
-		NextPlayerTurn()
+		DoCommand(('end',))
 		
 		if battle.active_player == 1:
 			# do AI turn
-			DoAITurn()
+			DoCommand(('ai',))
 			RenderAll()
-			NextPlayerTurn()
+			DoCommand(('end',))
 		
 	elif key.vk == libtcod.KEY_TAB:
 		# select first player unit, or next unit in list
@@ -2884,59 +4332,413 @@ def HandleInput():
 		key_char = chr(key.c)
 		
 		if battle.selected is not None:
-			if battle.selected.player == battle.active_player:
+			obj = battle.selected
+			if obj.player == battle.active_player:
 				if key_char == 'q':
-					battle.selected.ChangeFacing(-1)
+					DoCommand(('facing', obj.hx, obj.hy, -1))
 					RenderAll()
 				elif key_char == 'e':
-					battle.selected.ChangeFacing(1)
+					DoCommand(('facing', obj.hx, obj.hy, 1))
 					RenderAll()
 				elif key_char == 'w':
-					battle.selected.MoveForward()
+					DoCommand(('forward', obj.hx, obj.hy))
 					RenderAll()
 				elif key_char == 'f':
-					battle.selected.FreeAttempt()
+					DoCommand(('free', obj.hx, obj.hy))
 					RenderAll()
 	
 	return None
 
 
 # save current battle state to file
+# the battle is packed here, so later changes to it can't leak into the save,
+# and written to disk by the save writer
+# the first save of a battle is a full save, later ones only add what has
+# changed to the journal until it is long enough for another full save
 def SaveGame():
-	# clear unit consoles
-	for obj in battle.units:
-		del obj.stat_console
-		del obj.portrait
-		del obj.sprite
-	file = shelve.open('savegame', 'n')
-	file['battle'] = battle
-	file.close
+	global save_writer, save_journal
+	if save_writer is None:
+		save_writer = SaveWriter()
+	if save_journal is None or save_journal.battle is not battle or save_journal.entries >= JOURNAL_LENGTH:
+		save_journal = SaveJournal(battle, int(time.time() * 1000))
+		save_writer.Write('savegame', PackSave(battle, save_journal))
+		save_writer.Write('savegame.journal', '')
+	else:
+		data = struct.pack('<Q', save_journal.journal_id) + save_journal.Record()
+		save_writer.Append('savegame.journal', struct.pack('<I', len(data)) + data)
 	print 'Game saved'
-	# rebuild unit consoles
-	for obj in battle.units:
-		obj.SetupConsoles()
+
+
+# add saved game data to the end of a file
+def AppendSaveFile(filename, data):
+	file = open(filename, 'ab')
+	file.write(data)
+	file.flush()
+	os.fsync(file.fileno())
+	file.close()
+
+
+# write saved game data to a temporary file and then rename it over the save
+# file, so that the save file is never left half-written
+def WriteSaveFile(filename, data):
+	temp_filename = filename + '.tmp'
+	file = open(temp_filename, 'wb')
+	file.write(data)
+	file.flush()
+	os.fsync(file.fileno())
+	file.close()
+	# renaming can't replace an existing file on Windows, but MoveFileEx
+	# can, without there ever being no save file at all
+	if os.name == 'nt':
+		flags = MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+		if not ctypes.windll.kernel32.MoveFileExW(unicode(temp_filename), unicode(filename), flags):
+			raise ctypes.WinError()
+	else:
+		os.rename(temp_filename, filename)
+
+
+# wait for any saves in progress to be written to disk
+def WaitForSave():
+	if save_writer is not None:
+		save_writer.Wait()
 
 
 # load game state from file
 def LoadGame():
-	global battle
-	file = shelve.open('savegame', 'r')
-	battle = file['battle']
-	file.close()
+	global battle, save_journal
+	WaitForSave()
+	# shelve databases saved by older versions may have no 'savegame' file
+	# at all, only files such as 'savegame.dat' and 'savegame.dir', so a
+	# missing or unreadable file is left for shelve to open
+	try:
+		file = open('savegame', 'rb')
+		data = file.read()
+		file.close()
+	except IOError:
+		data = ''
+	
+	if data[:len(SAVE_MAGIC)] == SAVE_MAGIC:
+		# replay the journal on top of the full save
+		(journal_id, version, battle, units_by_id) = UnpackSave(data)
+		ReadJournal('savegame.journal', journal_id, version, battle, units_by_id)
+	else:
+		# games saved by older versions are pickled battles, either on their
+		# own, with a journal id, or in a shelve database; any journal they
+		# have is not read
+		# anything else is taken to be a shelve database
+		if data[:1] == '\x80':
+			battle = pickle.loads(data)
+			if isinstance(battle, tuple):
+				battle = battle[1]
+		else:
+			file = shelve.open('savegame', 'r')
+			battle = file['battle']
+			file.close()
+		# battles saved before terrain decorations were seeded
+		if 'map_seed' not in battle.__dict__:
+			battle.map_seed = 0
+		if 'message_count' not in battle.__dict__:
+			battle.message_count = len(battle.messages)
+		if 'rng' not in battle.__dict__:
+			battle.rng = BattleRandom(battle.map_seed)
+		if 'commands' not in battle.__dict__:
+			battle.seed = None
+			battle.commands = []
+	
+	# the next save is a full save, starting a new journal; this also moves
+	# games saved by older versions to the current format
+	save_journal = None
+	
+	# rebuild lookup tables, including for battles saved without them
+	battle.BuildIndexes()
 	# rebuild unit consoles
 	for obj in battle.units:
 		obj.SetupConsoles()
 	print 'Game loaded'
 
 
+# save files start with a SAVE_HEADER: SAVE_MAGIC, the format version, flags,
+# and the journal id; the rest of the file is the map and then the battle
+# state, compressed if SAVE_COMPRESSED is set in the flags
+# journal entries are a length and journal id followed by a battle state
+# holding only what has changed
+# numbers are little-endian, strings are a length followed by the text
+
+# returns a full save of the battle, recording units in the given journal
+def PackSave(battle, journal):
+	data = PackMap(battle) + journal.Record(full=True)
+	flags = 0
+	if COMPRESS_SAVES:
+		data = zlib.compress(data)
+		flags |= SAVE_COMPRESSED
+	return struct.pack(SAVE_HEADER, SAVE_MAGIC, SAVE_VERSION, flags, journal.journal_id) + data
+
+
+# returns a battle read from a full save, as (journal id, format version,
+# battle, units by id)
+def UnpackSave(data):
+	(magic, version, flags, journal_id) = struct.unpack_from(SAVE_HEADER, data)
+	if version > SAVE_VERSION:
+		raise IOError('savegame is from a newer version (' + str(version) + ')')
+	data = data[struct.calcsize(SAVE_HEADER):]
+	if flags & SAVE_COMPRESSED:
+		data = zlib.decompress(data)
+	reader = SaveReader(data, version)
+	battle = UnpackMap(reader)
+	units_by_id = {}
+	UnpackBattleState(reader, battle, units_by_id)
+	return (journal_id, version, battle, units_by_id)
+
+
+# apply the journal entries for the given journal id to a battle
+# stops at an entry that was cut short, since it would have been the last one
+def ReadJournal(filename, journal_id, version, battle, units_by_id):
+	if not os.path.exists(filename):
+		return
+	file = open(filename, 'rb')
+	reader = SaveReader(file.read(), version)
+	file.close()
+	while reader.Remaining() >= 4:
+		(length,) = reader.Read('<I')
+		if reader.Remaining() < length:
+			break
+		entry = SaveReader(reader.ReadBytes(length), version)
+		(entry_id,) = entry.Read('<Q')
+		if entry_id == journal_id:
+			UnpackBattleState(entry, battle, units_by_id)
+
+
+# returns a string packed with its length
+def PackString(text):
+	return struct.pack('<H', len(text)) + text
+
+
+# returns the battle seed, terrain hexes, rivers and roads of a battle, packed
+def PackMap(battle):
+	seed = battle.seed
+	if seed is None:
+		seed = -1
+	data = struct.pack('<IiH', battle.map_seed, seed, len(battle.map_hexes))
+	for h in battle.map_hexes:
+		data += struct.pack('<hhB???', h.hx, h.hy, h.terrain_type, h.road, h.river, h.higher_ground)
+		if h.landmark_name is None:
+			data += PackString('')
+		else:
+			data += PackString(h.landmark_name)
+	for paths in (battle.rivers, battle.roads):
+		data += struct.pack('<H', len(paths))
+		for path in paths:
+			data += struct.pack('<hhhh', *path)
+	return data
+
+
+# returns a new battle with the map read from a save file
+def UnpackMap(reader):
+	# saves from before version 3 have no battle seed
+	seed = -1
+	if reader.version >= 3:
+		(map_seed, seed, num_hexes) = reader.Read('<IiH')
+	else:
+		(map_seed, num_hexes) = reader.Read('<IH')
+	# saves from before version 2 have no random number state, their
+	# battles carry on with numbers seeded from the map seed
+	battle = Battle(map_seed, map_seed)
+	battle.seed = None
+	if seed >= 0:
+		battle.seed = seed
+	for n in range(num_hexes):
+		(hx, hy, terrain_type, road, river, higher_ground) = reader.Read('<hhB???')
+		h = Hex(hx, hy, terrain_type)
+		h.road = road
+		h.river = river
+		h.higher_ground = higher_ground
+		landmark_name = reader.ReadString()
+		if landmark_name != '':
+			h.landmark_name = landmark_name
+		h.SetTerrain()
+		battle.AddHex(h)
+	for paths in (battle.rivers, battle.roads):
+		(num_paths,) = reader.Read('<H')
+		for n in range(num_paths):
+			paths.append(reader.Read('<hhhh'))
+	return battle
+
+
+# returns a unit packed with its id
+# stats that come from the unit type are not included
+def PackUnit(obj, unit_id):
+	data = struct.pack('<H', unit_id) + PackString(obj.name)
+	data += struct.pack('<BhhBbHBbb???B', obj.player, obj.hx, obj.hy, obj.facing,
+		obj.ap, obj.fighters, obj.current_ranks, obj.attack_mod, obj.defense_mod,
+		obj.broken, obj.melee_locked, obj.free_attempt, len(obj.rank_pop))
+	data += struct.pack('<' + str(len(obj.rank_pop)) + 'B', *obj.rank_pop)
+	return data
+
+
+# read a unit from a save file, updating it if it's already in units_by_id or
+# adding it there if not
+def UnpackUnit(reader, units_by_id):
+	(unit_id,) = reader.Read('<H')
+	name = reader.ReadString()
+	(player, hx, hy, facing, ap, fighters, current_ranks, attack_mod, defense_mod,
+		broken, melee_locked, free_attempt, num_ranks) = reader.Read('<BhhBbHBbb???B')
+	if unit_id in units_by_id:
+		obj = units_by_id[unit_id]
+		obj.hx = hx
+		obj.hy = hy
+		obj.facing = facing
+	else:
+		# consoles are set up once the whole battle is loaded
+		obj = Unit(name, player, hx, hy, facing, consoles=False)
+		units_by_id[unit_id] = obj
+	obj.ap = ap
+	obj.fighters = fighters
+	obj.current_ranks = current_ranks
+	obj.attack_mod = attack_mod
+	obj.defense_mod = defense_mod
+	obj.broken = broken
+	obj.melee_locked = melee_locked
+	obj.free_attempt = free_attempt
+	obj.rank_pop = list(reader.Read('<' + str(num_ranks) + 'B'))
+
+
+# returns the battle turn, scores, messages, units, melee locks and commands
+# packed
+# units are given as their packed records, and referred to by their ids in
+# unit_ids
+def PackBattleState(battle, unit_ids, unit_records, messages, commands):
+	selected = -1
+	if battle.selected in unit_ids:
+		selected = unit_ids[battle.selected]
+	data = struct.pack('<HHBiihI', battle.current_turn, battle.turn_limit,
+		battle.active_player, battle.player0_score, battle.player1_score,
+		selected, battle.message_count)
+	data += struct.pack('<Q', battle.rng.state)
+	data += struct.pack('<H', len(messages))
+	for (line, color) in messages:
+		data += PackString(line) + struct.pack('<BBB', color.r, color.g, color.b)
+	data += struct.pack('<H', len(unit_records)) + ''.join(unit_records)
+	data += struct.pack('<H', len(battle.units))
+	for obj in battle.units:
+		data += struct.pack('<H', unit_ids[obj])
+	data += struct.pack('<H', len(battle.melee_locks))
+	for (obj1, obj2) in battle.melee_locks:
+		data += struct.pack('<HH', unit_ids[obj1], unit_ids[obj2])
+	data += struct.pack('<I', len(commands))
+	for command in commands:
+		data += PackString(command[0]) + struct.pack('<B', len(command)-1)
+		data += struct.pack('<' + str(len(command)-1) + 'h', *command[1:])
+	return data
+
+
+# read the battle state from a save file into a battle
+def UnpackBattleState(reader, battle, units_by_id):
+	(battle.current_turn, battle.turn_limit, battle.active_player, battle.player0_score,
+		battle.player1_score, selected, battle.message_count) = reader.Read('<HHBiihI')
+	if reader.version >= 2:
+		(battle.rng.state,) = reader.Read('<Q')
+	
+	# add messages the same way as Message()
+	(num_messages,) = reader.Read('<H')
+	for n in range(num_messages):
+		line = reader.ReadString()
+		(r, g, b) = reader.Read('<BBB')
+		if len(battle.messages) == MSG_CON_HEIGHT:
+			del battle.messages[0]
+		battle.messages.append((line, libtcod.Color(r, g, b)))
+	
+	(num_units,) = reader.Read('<H')
+	for n in range(num_units):
+		UnpackUnit(reader, units_by_id)
+	
+	(num_units,) = reader.Read('<H')
+	battle.units = [units_by_id[unit_id] for unit_id in reader.Read('<' + str(num_units) + 'H')]
+	
+	battle.melee_locks = []
+	(num_locks,) = reader.Read('<H')
+	for n in range(num_locks):
+		(id1, id2) = reader.Read('<HH')
+		battle.melee_locks.append((units_by_id[id1], units_by_id[id2]))
+	
+	battle.selected = None
+	if selected >= 0:
+		battle.selected = units_by_id[selected]
+	
+	if reader.version >= 3:
+		(num_commands,) = reader.Read('<I')
+		for n in range(num_commands):
+			name = reader.ReadString()
+			(num_values,) = reader.Read('<B')
+			battle.commands.append((name,) + reader.Read('<' + str(num_values) + 'h'))
+
+
 ################################################################################
 #                               Main Battle Loop                               #
 ################################################################################
 
+# create a new battle with the default scenario: generates the map and spawns
+# the units for both players
+# seed sets the battle's random numbers, so the same seed gives the same battle
+def NewBattle(seed=None):
+	global battle
+	
+	# create battle object
+	battle = Battle(seed)
+	
+	# generate the battle map
+	#GenerateMap()
+	GenerateTestMap()
+	
+	# spawn player's units
+	
+	# TODO: read from roster
+	
+	# player's units
+	SpawnUnit('Hearthguard', 0, 5, 3, 0)
+	SpawnUnit('Hearthguard', 0, 6, 3, 0)
+	SpawnUnit('Hearthguard', 0, 7, 4, 0)
+	
+	#SpawnUnit('Irregulars', 0, 3, 2, 0)
+	#SpawnUnit('Irregulars', 0, 9, 5, 0)
+	
+	SpawnUnit('Longbowmen', 0, 5, 2, 0)
+	SpawnUnit('Longbowmen', 0, 7, 3, 0)
+	
+	SpawnUnit('Knights', 0, 4, 2, 0)
+	SpawnUnit('Knights', 0, 8, 4, 0)
+	
+	#SpawnUnit('Noble Riders', 0, 3, 1, 0)
+	#SpawnUnit('Noble Riders', 0, 9, 4, 0)
+	
+	
+	
+	# enemy units
+	SpawnUnit('Ghouls', 1, 5, 8, 3)
+	SpawnUnit('Ghouls', 1, 6, 9, 3)
+	SpawnUnit('Ghouls', 1, 7, 9, 3)
+	
+	#SpawnUnit('Skeletal Host', 1, 4, 9, 3)
+	#SpawnUnit('Skeletal Host', 1, 8, 11, 3)
+	
+	SpawnUnit('Skeleton Archers', 1, 5, 9, 3)
+	SpawnUnit('Skeleton Archers', 1, 7, 10, 3)
+	
+	#SpawnUnit('Vampire Lords', 1, 5, 8, 3)
+	#SpawnUnit('Vampire Lords', 1, 7, 9, 3)
+	
+	SpawnUnit('Knightmares', 1, 4, 8, 3)
+	SpawnUnit('Knightmares', 1, 8, 10, 3)
+	
+	Message('Battle commences!')
+
+
 # set up and run a battle, if load_battle is true then load last saved game
 def DoBattle(roster, load_battle = False):
 	
-	global battle, session
+	global battle, session, presenter
+	
+	# draw everything to the screen
+	presenter = ConsolePresenter()
 	
 	# if we're continuing a battle, load it
 	# TODO: test loading and if failsm, show an error message and quit to main menu
@@ -2946,59 +4748,13 @@ def DoBattle(roster, load_battle = False):
 		PaintMap()
 		
 	else:
-		# create battle object
-		battle = Battle()
-		
 		# create session object
 		session = Session()
 		
-		# generate the battle map and draw the map console
-		#GenerateMap()
-		GenerateTestMap()
+		# generate the battle map and units, and draw the map console
+		NewBattle()
 		PaintMap()
 		
-		# spawn player's units
-		
-		# TODO: read from roster
-		
-		# player's units
-		SpawnUnit('Hearthguard', 0, 5, 3, 0)
-		SpawnUnit('Hearthguard', 0, 6, 3, 0)
-		SpawnUnit('Hearthguard', 0, 7, 4, 0)
-		
-		#SpawnUnit('Irregulars', 0, 3, 2, 0)
-		#SpawnUnit('Irregulars', 0, 9, 5, 0)
-		
-		SpawnUnit('Longbowmen', 0, 5, 2, 0)
-		SpawnUnit('Longbowmen', 0, 7, 3, 0)
-		
-		SpawnUnit('Knights', 0, 4, 2, 0)
-		SpawnUnit('Knights', 0, 8, 4, 0)
-		
-		#SpawnUnit('Noble Riders', 0, 3, 1, 0)
-		#SpawnUnit('Noble Riders', 0, 9, 4, 0)
-		
-		
-		
-		# enemy units
-		SpawnUnit('Ghouls', 1, 5, 8, 3)
-		SpawnUnit('Ghouls', 1, 6, 9, 3)
-		SpawnUnit('Ghouls', 1, 7, 9, 3)
-		
-		#SpawnUnit('Skeletal Host', 1, 4, 9, 3)
-		#SpawnUnit('Skeletal Host', 1, 8, 11, 3)
-		
-		SpawnUnit('Skeleton Archers', 1, 5, 9, 3)
-		SpawnUnit('Skeleton Archers', 1, 7, 10, 3)
-		
-		#SpawnUnit('Vampire Lords', 1, 5, 8, 3)
-		#SpawnUnit('Vampire Lords', 1, 7, 9, 3)
-		
-		SpawnUnit('Knightmares', 1, 4, 8, 3)
-		SpawnUnit('Knightmares', 1, 8, 10, 3)
-		
-		Message('Battle commences!')
-	
 		# save game state
 		SaveGame()
 	
@@ -3017,9 +4773,712 @@ def DoBattle(roster, load_battle = False):
 		player_action = HandleInput()
 		if player_action == 'exit':
 			break
+		
+		# let the AI think about its next turn while the player takes theirs
+		if search_ai is not None:
+			search_ai.Ponder()
+	
+	# keep a replay of the battle so far
+	if battle.seed is not None:
+		if not os.path.isdir(REPLAY_DIR):
+			os.makedirs(REPLAY_DIR)
+		WriteReplay(os.path.join(REPLAY_DIR, 'battle-' + str(battle.seed) + '.txt'))
+
+	battle = None
+	session = None
+	presenter = Presenter()
+
+
+################################################################################
+#                               Battle Simulator                               #
+################################################################################
+
+# most battles handed to a simulation worker at one time
+SIM_CHUNK_SIZE = 50
+
+
+# returns True if player has any units left in the battle
+def PlayerHasUnits(player):
+	for obj in battle.units:
+		if obj.player == player:
+			return True
+	return False
+
+
+# returns the total points cost of a player's surviving units, scaled by how
+# many of their fighters are left
+def GetForceStrength(player):
+	strength = 0.0
+	for obj in battle.units:
+		if obj.player == player:
+			strength += float(obj.unit_type.points_cost) * obj.fighters / obj.max_fighters
+	return strength
+
+
+# returns a new set of simulation totals
+def NewSimTotals():
+	return {'battles' : 0, 'wins' : [0, 0], 'draws' : 0, 'turns' : 0,
+		'fighters_lost' : [0, 0], 'units_lost' : [0, 0]}
+
+
+# add the totals from one set of simulation results to another
+def AddSimTotals(totals, more):
+	totals['battles'] += more['battles']
+	totals['draws'] += more['draws']
+	totals['turns'] += more['turns']
+	for player in range(2):
+		totals['wins'][player] += more['wins'][player]
+		totals['fighters_lost'][player] += more['fighters_lost'][player]
+		totals['units_lost'][player] += more['units_lost'][player]
+
+
+# returns the number of fighters and units each player has in the battle, as
+# (fighters, units) lists indexed by player
+def CountForces():
+	fighters = [0, 0]
+	units = [0, 0]
+	for obj in battle.units:
+		fighters[obj.player] += obj.fighters
+		units[obj.player] += 1
+	return (fighters, units)
+
+
+# play out one headless AI-vs-AI battle with the default scenario, and add
+# the results to totals
+# if record_dir is given, a replay of the battle is written there
+def SimulateBattle(seed, totals, record_dir=None):
+	NewBattle(seed)
+	start_forces = CountForces()
+	
+	# both players are controlled by the AI, until the turn limit is reached
+	# or one side has been wiped out
+	while battle.current_turn <= battle.turn_limit:
+		DoCommand(('ai',))
+		DoCommand(('end',))
+		if not PlayerHasUnits(0) or not PlayerHasUnits(1):
+			break
+	
+	AddBattleResult(totals, start_forces)
+	if record_dir is not None:
+		WriteReplay(os.path.join(record_dir, 'battle-' + str(seed) + '.txt'))
+
+
+# add the result of the current battle to totals, given the forces each player
+# started with from CountForces()
+def AddBattleResult(totals, start_forces):
+	totals['battles'] += 1
+	totals['turns'] += min(battle.current_turn, battle.turn_limit)
+	
+	# tally casualties
+	(start_fighters, start_units) = start_forces
+	(fighters, units) = CountForces()
+	for player in range(2):
+		totals['fighters_lost'][player] += start_fighters[player] - fighters[player]
+		totals['units_lost'][player] += start_units[player] - units[player]
+	
+	# the player with the greater surviving strength wins
+	strength0 = GetForceStrength(0)
+	strength1 = GetForceStrength(1)
+	if strength0 > strength1:
+		totals['wins'][0] += 1
+	elif strength1 > strength0:
+		totals['wins'][1] += 1
+	else:
+		totals['draws'] += 1
+
+
+# set up a simulation worker process: battles are run headless and anything
+# printed by the battle rules is discarded
+# search_ai is used for the AI players in the simulated battles, if given
+# position is the shared number of the position the searching AI is
+# pondering, if the worker ponders for it
+def InitSimWorker(search=None, position=None):
+	global session, presenter, search_ai, ponder_position
+	session = None
+	presenter = Presenter()
+	search_ai = search
+	ponder_position = position
+	sys.stdout = open(os.devnull, 'w')
+
+
+# simulate a chunk of battles, given as (first seed, number of battles,
+# replay directory or None), and return the totals
+def SimulateChunk(chunk):
+	(first_seed, num_battles, record_dir) = chunk
+	totals = NewSimTotals()
+	for seed in range(first_seed, first_seed + num_battles):
+		SimulateBattle(seed, totals, record_dir)
+	return totals
+
+
+# play num_battles AI-vs-AI battles split across a pool of worker processes,
+# and print a report of the results
+# battles use the seeds first_seed to first_seed + num_battles - 1; each
+# battle has its own random number stream, so with the greedy AI its result
+# only depends on its seed, and a run gives the same totals again on any
+# number of workers (the searching AI stops on a time limit, so it doesn't)
+# if record_dir is given, a replay of each battle is written there
+# if search is given, it is used for the AI players instead of the greedy AI
+def RunSimulation(num_battles, workers, first_seed=0, record_dir=None, search=None):
+	if record_dir is not None and not os.path.isdir(record_dir):
+		os.makedirs(record_dir)
+	
+	# split the battles into chunks, small enough that every worker gets
+	# several of them
+	chunk_size = max(1, min(SIM_CHUNK_SIZE, num_battles // (workers * 4)))
+	chunks = []
+	seed = first_seed
+	remaining = num_battles
+	while remaining > 0:
+		n = min(chunk_size, remaining)
+		chunks.append((seed, n, record_dir))
+		seed += n
+		remaining -= n
+	
+	print 'Simulating ' + str(num_battles) + ' battles on ' + str(workers) + ' workers...'
+	start_time = time.time()
+	
+	totals = NewSimTotals()
+	pool = Pool(workers, InitSimWorker, (search,))
+	try:
+		results = pool.imap_unordered(SimulateChunk, chunks)
+		for i in range(len(chunks)):
+			# waiting with a timeout keeps the main process responsive to Ctrl-C
+			AddSimTotals(totals, results.next(timeout=86400))
+			sys.stdout.write('\r' + str(totals['battles']) + '/' + str(num_battles) + ' battles')
+			sys.stdout.flush()
+		pool.close()
+	except KeyboardInterrupt:
+		pool.terminate()
+		print '\nSimulation interrupted'
+	pool.join()
+	print
+	
+	PrintSimReport(totals, time.time() - start_time)
+
+
+# print a report of simulation totals, and how long the battles took to play
+def PrintSimReport(totals, elapsed):
+	n = totals['battles']
+	if n == 0: return
+	print 'Completed ' + str(n) + ' battles in ' + ('%.1f' % elapsed) + ' seconds (' + ('%.1f' % (n / elapsed)) + ' battles per second)'
+	for player in range(2):
+		text = 'Player ' + str(player+1) + ': '
+		text += ('%.1f' % (100.0 * totals['wins'][player] / n)) + '% wins, '
+		text += ('%.2f' % (float(totals['fighters_lost'][player]) / n)) + ' fighters and '
+		text += ('%.2f' % (float(totals['units_lost'][player]) / n)) + ' units lost per battle'
+		print text
+	print 'Draws: ' + ('%.1f' % (100.0 * totals['draws'] / n)) + '%'
+	print 'Average length: ' + ('%.2f' % (float(totals['turns']) / n)) + ' turns'
+
+
+################################################################################
+#                                Battle Replays                                #
+################################################################################
+
+# a replay is a text file giving the seed of a battle and then the commands
+# given in it, one to a line, as recorded by DoCommand()
+
+# write a replay of the current battle to a file
+def WriteReplay(filename):
+	file = open(filename, 'w')
+	file.write('WarHexer replay ' + VERSION + '\n')
+	file.write('seed ' + str(battle.seed) + '\n')
+	for command in battle.commands:
+		file.write(' '.join([str(value) for value in command]) + '\n')
+	file.close()
+
+
+# returns the seed and list of commands from a replay file
+def ReadReplay(filename):
+	file = open(filename, 'r')
+	lines = file.read().splitlines()
+	file.close()
+	seed = None
+	commands = []
+	for line in lines[1:]:
+		words = line.split()
+		if len(words) == 0: continue
+		if words[0] == 'seed':
+			seed = int(words[1])
+		else:
+			commands.append(tuple([words[0]] + [int(word) for word in words[1:]]))
+	return (seed, commands)
+
+
+# play a replay's commands on the current battle
+# if delay is given, the screen is redrawn and held for delay milliseconds
+# after each command; returns False if the window was closed
+def PlayCommands(commands, delay=None):
+	global replay_commands
+	replay_commands = deque(commands)
+	try:
+		while len(replay_commands) > 0:
+			command = replay_commands.popleft()
+			# answers that were not asked for any more are skipped
+			if command[0] == 'answer':
+				continue
+			DoCommand(command)
+			if delay is not None:
+				RenderAll()
+				libtcod.console_flush()
+				libtcod.sys_sleep_milli(delay)
+				if libtcod.console_is_window_closed():
+					return False
+	finally:
+		replay_commands = None
+	return True
+
+
+# play replay files headless at full speed, printing the result of each and
+# a report of the totals
+# results only change if the battle rules do, so runs before and after a rule
+# change can be compared
+def RunReplays(filenames):
+	global session, presenter
+	session = None
+	presenter = Presenter()
+	
+	start_time = time.time()
+	totals = NewSimTotals()
+	for filename in filenames:
+		(seed, commands) = ReadReplay(filename)
+		NewBattle(seed)
+		start_forces = CountForces()
+		PlayCommands(commands)
+		
+		result = NewSimTotals()
+		AddBattleResult(result, start_forces)
+		AddSimTotals(totals, result)
+		if result['wins'][0] > 0:
+			text = 'Player 1 wins'
+		elif result['wins'][1] > 0:
+			text = 'Player 2 wins'
+		else:
+			text = 'Draw'
+		text += ', turn ' + str(result['turns'])
+		text += ', fighters lost ' + str(result['fighters_lost'][0]) + '-' + str(result['fighters_lost'][1])
+		text += ', units lost ' + str(result['units_lost'][0]) + '-' + str(result['units_lost'][1])
+		print filename + ': ' + text
+	
+	PrintSimReport(totals, time.time() - start_time)
+
+
+# watch replay files played out in the game window, waiting delay
+# milliseconds after each command
+def ShowReplays(filenames, delay):
+	global battle, session, presenter
+	presenter = ReplayPresenter(delay)
+	for filename in filenames:
+		(seed, commands) = ReadReplay(filename)
+		session = Session()
+		NewBattle(seed)
+		PaintMap()
+		RenderAll()
+		if not PlayCommands(commands, delay):
+			break
+		Message('Replay finished, press Space to continue.')
+		RenderAll()
+		WaitForSpace()
+	battle = None
+	session = None
+	presenter = Presenter()
+
+
+################################################################################
+#                                   AI Search                                  #
+################################################################################
+
+# the searching AI plans a whole turn as one option for each of its units in
+# turn: act as the greedy AI, advance, attack one of its best targets, or hold
+# plans are tried out with a Monte Carlo tree search: each playout plays a plan
+# with new dice on the battle, has the greedy AI finish the turn and the enemy
+# reply, scores the result, and rolls the battle back to a snapshot
+# playouts run in a pool of worker processes, each searching on its own copy
+# of the battle, and the most tried plan across all workers is played
+# while the other player takes their turn, the workers ponder the position the
+# AI's turn would start from if that turn ended now, and the search of the
+# position the AI's turn does start from carries on from that
+
+# settings and worker pool for the searching AI
+class SearchAI:
+	def __init__(self, time_limit, workers, players):
+		self.time_limit = time_limit	# seconds to search for each turn
+		self.workers = workers		# worker processes, searches in this process if 0
+		self.players = players		# players that use the searching AI
+		self.pool = None		# worker pool, started when first needed
+		self.playouts = 0		# number of playouts in the latest search
+		
+		self.pondered = TranspositionTable(PONDER_POSITIONS)	# [seconds, playouts, stats] by state hash
+		self.ponder_key = None		# battle hash and random state being pondered
+		self.ponder_task = None		# task from GetPonderTask() for that battle
+		self.ponder_results = []	# (state hash, result) of each running worker
+		self.ponder_position = None	# number of the position being pondered, shared with the workers
+	
+	
+	# the worker pool and running work are not copied along with the settings
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['pool'] = None
+		state['ponder_results'] = []
+		state['ponder_position'] = None
+		return state
+	
+	
+	# start the worker pool, if searches are done in workers
+	def StartPool(self):
+		if self.workers > 0 and self.pool is None:
+			self.ponder_position = RawValue('i', 0)
+			self.pool = Pool(self.workers, InitSimWorker, (None, self.ponder_position))
+	
+	
+	# think about the next player's turn while the current player takes
+	# theirs; called regularly from the battle loop, this only gathers
+	# finished work and hands out more, starting on a new position whenever
+	# the battle changes
+	def Ponder(self):
+		if self.pool is None: return
+		if 1 - battle.active_player not in self.players: return
+		self.CollectPonder()
+		
+		key = (battle.GetStateHash(), battle.rng.state)
+		if key != self.ponder_key:
+			self.StopPonder()
+			self.ponder_key = key
+			self.ponder_task = GetPonderTask()
+		if self.ponder_task is None: return
+		
+		(state_hash, data, order, options) = self.ponder_task
+		while len(self.ponder_results) < self.workers:
+			deadline = time.time() + PONDER_SLICE
+			seed = libtcod.random_get_int(0, 0, 0x7FFFFFFF)
+			task = (data, order, options, deadline, seed, self.ponder_position.value)
+			result = self.pool.apply_async(SearchWorker, (task,))
+			self.ponder_results.append((state_hash, result))
+	
+	
+	# stop the pondering that is running, dropping whatever it has found;
+	# the workers stop after the playout they are on, so that they are free
+	# for new work straight away
+	def StopPonder(self):
+		self.ponder_results = []
+		if self.ponder_position is not None:
+			self.ponder_position.value += 1
+	
+	
+	# add finished pondering to the stats of the position it was for
+	# if state_hash is given, also waits until deadline for the pondering of
+	# that position still running, and drops the pondering of any other one
+	def CollectPonder(self, state_hash=None, deadline=None):
+		for (ponder_hash, result) in self.ponder_results[:]:
+			if not result.ready():
+				if state_hash is None: continue
+				if ponder_hash == state_hash:
+					result.wait(max(0.0, deadline - time.time()))
+				if not result.ready():
+					self.ponder_results.remove((ponder_hash, result))
+					continue
+			self.ponder_results.remove((ponder_hash, result))
+			(playouts, stats) = result.get()
+			entry = self.pondered.Get(ponder_hash)
+			if entry is None:
+				entry = [0.0, 0, {}]
+				self.pondered.Put(ponder_hash, entry)
+			# workers ponder side by side, so each only adds its share of
+			# the search time
+			entry[0] += PONDER_SLICE / self.workers
+			entry[1] += playouts
+			AddSearchStats(entry[2], stats)
+	
+	
+	# search for a plan for the active player's turn, given the search order
+	# and options from GetSearchOrder() and GetSearchOptions(); returns the
+	# best plan found before the time limit
+	# the time spent pondering this position counts toward the time limit, and
+	# so does waiting for that pondering to finish
+	def FindPlan(self, order, options):
+		global presenter, session
+		deadline = time.time() + self.time_limit
+		self.playouts = 0
+		stats = {}
+		
+		if self.pool is not None:
+			# pondering of this position that is still running is only waited
+			# for as long as the time limit isn't made up by pondering already
+			state_hash = battle.GetStateHash()
+			entry = self.pondered.Get(state_hash)
+			if entry is not None:
+				self.CollectPonder(state_hash, deadline - entry[0])
+			else:
+				self.CollectPonder(state_hash, deadline)
+			entry = self.pondered.Get(state_hash)
+			if entry is not None:
+				(seconds, playouts, ponder_stats) = entry
+				deadline -= seconds
+				self.playouts += playouts
+				AddSearchStats(stats, ponder_stats)
+			# the battle will have changed by the next time there's pondering,
+			# and the workers are needed for searching
+			self.StopPonder()
+			self.ponder_key = None
+		
+		# with enough pondering done, there is no need to search any more
+		if time.time() >= deadline and len(stats) > 0:
+			return GetBestPlan(stats, options)
+		
+		seed = libtcod.random_get_int(0, 0, 0x7FFFFFFF)
+		
+		if self.workers > 0:
+			self.StartPool()
+			data = pickle.dumps(battle, pickle.HIGHEST_PROTOCOL)
+			tasks = [(data, order, options, deadline, seed + n, None) for n in range(self.workers)]
+			results = self.pool.imap_unordered(SearchWorker, tasks)
+			# workers that haven't reported by the time limit are left out
+			for n in range(self.workers):
+				try:
+					(playouts, worker_stats) = results.next(timeout=max(0.0, deadline - time.time()) + SEARCH_GRACE)
+				except TimeoutError:
+					break
+				self.playouts += playouts
+				AddSearchStats(stats, worker_stats)
+		
+		else:
+			# playouts are not drawn, and must not autosave
+			(old_presenter, old_session) = (presenter, session)
+			(presenter, session) = (Presenter(), None)
+			try:
+				(playouts, stats) = SearchPlans(order, options, deadline, seed)
+			finally:
+				(presenter, session) = (old_presenter, old_session)
+			self.playouts += playouts
+		
+		return GetBestPlan(stats, options)
+
+
+# add the [visits, value] of each plan in one set of search stats to another
+def AddSearchStats(stats, more):
+	for (plan, (visits, value)) in more.iteritems():
+		entry = stats.setdefault(plan, [0, 0.0])
+		entry[0] += visits
+		entry[1] += value
+
+
+# returns the search task for pondering the next player's turn, as (state
+# hash, pickled battle, order, options) for the position that turn would
+# start from if the current turn ended now, or None if there is nothing to
+# search
+def GetPonderTask():
+	global presenter, session
+	logging = battle.undo_log is not None
+	snapshot = battle.Snapshot()
+	
+	# ending the turn is not drawn, and must not autosave
+	(old_presenter, old_session) = (presenter, session)
+	(presenter, session) = (Presenter(), None)
+	try:
+		NextPlayerTurn()
+		task = None
+		order = GetSearchOrder()
+		if len(order) > 0:
+			options = [GetSearchOptions(i) for i in order]
+			data = pickle.dumps(battle, pickle.HIGHEST_PROTOCOL)
+			task = (battle.GetStateHash(), data, order, options)
+		battle.Rollback(snapshot)
+	finally:
+		(presenter, session) = (old_presenter, old_session)
+	
+	if not logging:
+		battle.ClearSnapshots()
+	return task
+
+
+# play the active player's turn with the searching AI
+def DoSearchTurn():
+	units = list(battle.units)
+	order = GetSearchOrder()
+	options = [GetSearchOptions(i) for i in order]
+	plan = ()
+	if len(order) > 0:
+		plan = search_ai.FindPlan(order, options)
+	PlayPlan(units, order, plan)
+	Message('DEBUG: AI Done! (' + str(search_ai.playouts) + ' playouts)')
+
+
+# returns the active player's units that can act this turn, as indexes into
+# the battle's units, with those nearest the enemy first
+def GetSearchOrder():
+	order = []
+	for (i, obj) in enumerate(battle.units):
+		if obj.player != battle.active_player or obj.broken: continue
+		distances = [GetHexDistance(obj.hx, obj.hy, obj2.hx, obj2.hy) for obj2 in battle.units if obj2.player != obj.player]
+		if len(distances) == 0: distances = [0]
+		order.append((min(distances), i))
+	order.sort()
+	return [i for (distance, i) in order]
+
+
+# returns the plan options for the unit at index i of the battle's units;
+# targets are given as indexes into the battle's units too
+def GetSearchOptions(i):
+	obj = battle.units[i]
+	options = [('ai_unit',), ('hold',)]
+	
+	# units locked in melee can only fight the units they are locked with
+	if obj.melee_locked:
+		targets = [obj2 for obj2 in obj.GetAdjacentEnemies(obj.hx, obj.hy) if battle.IsMeleeLocked(obj, obj2)]
+		scored_list = [(ScoreAttack(obj, obj2), obj2) for obj2 in targets]
+	else:
+		options.append(('ai_advance',))
+		scored_list = []
+		if obj.melee > 0:
+			reach = ReachMap(obj, max_cost=obj.ap-1)
+			for (score, hx, hy, obj2) in obj.AIGetMeleeMoves(reach):
+				scored_list.append((score, obj2))
+		elif obj.ranged > 0:
+			for obj2 in battle.units:
+				if obj2.player == obj.player: continue
+				dist = GetHexDistance(obj.hx, obj.hy, obj2.hx, obj2.hy)
+				if dist <= obj.attack_range and not obj.CheckLoS(obj2):
+					scored_list.append((-dist, obj2))
+	
+	# the best few targets, by their best score
+	best = {}
+	for (score, obj2) in scored_list:
+		if obj2 not in best or score > best[obj2]:
+			best[obj2] = score
+	targets = sorted([(-score, battle.units.index(obj2)) for (obj2, score) in best.iteritems()])
+	for (score, target) in targets[:SEARCH_TARGETS]:
+		options.append(('ai_attack', target))
+	return options
+
+
+# returns the command for one unit's option in a plan, or None if the unit
+# does nothing; units and targets are found in the list of units the plan
+# was made for
+def GetPlanCommand(units, i, option):
+	obj = units[i]
+	if obj not in battle.units or obj.broken: return None
+	if option[0] == 'hold': return None
+	if option[0] == 'ai_attack':
+		target = units[option[1]]
+		if target not in battle.units:
+			return ('ai_unit', obj.hx, obj.hy)
+		return ('ai_attack', obj.hx, obj.hy, target.hx, target.hy)
+	return (option[0], obj.hx, obj.hy)
+
+
+# carry out a plan for the active player's turn: the option for each unit in
+# the plan, in order, and the greedy AI for the units after the end of the plan
+def PlayPlan(units, order, plan):
+	for (n, i) in enumerate(order):
+		if n < len(plan):
+			option = plan[n]
+		else:
+			option = ('ai_unit',)
+		command = GetPlanCommand(units, i, option)
+		if command is not None:
+			DoCommand(command)
+
+
+# returns how well the battle is going for a player, from 0 to 1, by the
+# strength of each side; broken units count for half
+def EvaluateBattle(player):
+	strength = [0.0, 0.0]
+	for obj in battle.units:
+		value = float(obj.unit_type.points_cost) * obj.fighters / obj.max_fighters
+		if obj.broken:
+			value = value / 2.0
+		strength[obj.player] += value
+	total = strength[0] + strength[1]
+	if total == 0.0:
+		return 0.5
+	return strength[player] / total
+
+
+# run a Monte Carlo tree search of plans for the active player's turn on the
+# current battle, until the deadline; playouts are rolled back, so the battle
+# is left as it was
+# returns the number of playouts, and the number of times each plan, or start
+# of a plan, was tried along with the total of its scores, as [visits, value]
+# pondering is the number of the position being pondered, if this is pondering
+def SearchPlans(order, options, deadline, seed, pondering=None):
+	player = battle.active_player
+	units = list(battle.units)
+	rng = BattleRandom(seed)
+	stats = {(): [0, 0.0]}
+	logging = battle.undo_log is not None
+	snapshot = battle.Snapshot()
+	playouts = 0
+	
+	while playouts == 0 or time.time() < deadline:
+		# pondering stops early once the AI has moved on to another position
+		if pondering is not None and ponder_position.value != pondering:
+			break
+		
+		# go down the tree of plans, picking the best option for each unit by
+		# score and how often it has been tried, until reaching an option that
+		# has not been tried yet
+		plan = ()
+		while len(plan) < len(order):
+			unit_options = options[len(plan)]
+			untried = [option for option in unit_options if plan + (option,) not in stats]
+			if len(untried) > 0:
+				plan = plan + (untried[0],)
+				stats[plan] = [0, 0.0]
+				break
+			log_visits = log(stats[plan][0])
+			best = None
+			for option in unit_options:
+				(visits, value) = stats[plan + (option,)]
+				score = value / visits + SEARCH_EXPLORATION * sqrt(log_visits / visits)
+				if best is None or score > best[0]:
+					best = (score, option)
+			plan = plan + (best[1],)
+		
+		# play out the plan with new dice, then the enemy's greedy reply
+		battle.rng.state = rng.Next()
+		PlayPlan(units, order, plan)
+		NextPlayerTurn()
+		DoAITurn()
+		value = EvaluateBattle(player)
+		battle.Rollback(snapshot)
+		playouts += 1
+		
+		for n in range(len(plan) + 1):
+			entry = stats[plan[:n]]
+			entry[0] += 1
+			entry[1] += value
+	
+	if not logging:
+		battle.ClearSnapshots()
+	return (playouts, stats)
 
-	del battle
-	del session
+
+# run SearchPlans() in a worker process, given (pickled battle, order, options,
+# deadline, seed, pondering), on the worker's own copy of the battle
+def SearchWorker(task):
+	global battle
+	(data, order, options, deadline, seed, pondering) = task
+	battle = pickle.loads(data)
+	battle.BuildIndexes()
+	return SearchPlans(order, options, deadline, seed, pondering)
+
+
+# returns the most tried plan from search stats, for as long as its options
+# were tried more than once
+def GetBestPlan(stats, options):
+	plan = ()
+	while len(plan) < len(options):
+		best = None
+		for option in options[len(plan)]:
+			entry = stats.get(plan + (option,))
+			if entry is not None and entry[0] > 1:
+				if best is None or entry[0] > best[0]:
+					best = (entry[0], option)
+		if best is None:
+			break
+		plan = plan + (best[1],)
+	return plan
 
 
 ################################################################################
@@ -3068,12 +5527,16 @@ def InGameMenu():
 		
 		if key_char == 'q' or libtcod.console_is_window_closed():
 			SaveGame()
+			WaitForSave()
 			return True
 		
 		elif key_char == 'a':
 			# TODO: get confirmation
+			WaitForSave()
 			if os.path.exists('savegame'):
 				os.remove('savegame')
+			if os.path.exists('savegame.journal'):
+				os.remove('savegame.journal')
 			return True
 			
 		# refresh the screen
@@ -3480,34 +5943,123 @@ def ForceSelectionMenu():
 global mouse, key
 global unit_classes
 
-# set up basic stuff
-os.environ['SDL_VIDEO_CENTERED'] = '1'		# center window on screen
-libtcod.console_set_custom_font('terminal10x16_gs_ro.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_ASCII_INROW)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'WarHexer', False)
-libtcod.sys_set_fps(LIMIT_FPS)
-libtcod.console_set_keyboard_repeat(0, 0)
-
-# create the main display console
-con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
-libtcod.console_set_default_background(con, libtcod.black)
-libtcod.console_set_default_foreground(con, libtcod.white)
-libtcod.console_set_alignment(con, libtcod.LEFT)
-libtcod.console_clear(con)
-
-# create mouse and key event holders
-mouse = libtcod.Mouse()
-key = libtcod.Key()
-
 # set up unit types
 unit_classes = []
 for stats in UNIT_CLASS_DEFS:
 	new_type = UnitType(stats)
 	unit_classes.append(new_type)
 
-# TEMP - for testing
-#DoBattle(None)
-
-# display the main game menu
-MainMenu()
+# exact attack result odds, keyed by attack and defense values and flags
+attack_odds = {}
+BuildAttackOdds()
+
+# current battle, session, and presenter; with no session and the default
+# presenter, battles run headless without a root console
+battle = None
+session = None
+presenter = Presenter()
+
+# HexTopology tables, keyed by the map hex coordinates they were built for
+topology_cache = {}
+
+# consoles holding painted maps, keyed by Battle.GetMapHash()
+terrain_cache = OrderedDict()
+
+# consoles holding drawn unit sprites, keyed by Unit.GetSpriteKey()
+sprite_cache = OrderedDict()
+
+# consoles holding loaded unit portraits, keyed by portrait filename
+portrait_cache = {}
+
+# background writer for saved games, started by the first save
+save_writer = None
+
+# changes to the current battle since its last full save
+save_journal = None
+
+# commands left to play while a replay is being played
+replay_commands = None
+
+# settings for the searching AI, None if all AI players use the greedy AI
+search_ai = None
+
+# in a pondering worker, the shared number of the position being pondered
+ponder_position = None
+
+# only handle the command line and open the game window if run as a script,
+# so the battle engine can be imported and run headless
+if __name__ == '__main__':
+	
+	# in the frozen Windows executable, worker processes start by running this
+	# script again, and go off to do their work here instead
+	freeze_support()
+	
+	parser = argparse.ArgumentParser(description='WarHexer: Roguelike Epic Fanasty Battles')
+	parser.add_argument('--simulate', type=int, metavar='N',
+		help='play N headless AI-vs-AI battles and report the results')
+	parser.add_argument('--workers', type=int, default=cpu_count(),
+		help='number of worker processes for --simulate and --search (default: one per CPU)')
+	parser.add_argument('--seed', type=int, default=0,
+		help='random seed of the first simulated battle (default: 0)')
+	parser.add_argument('--record', metavar='DIR',
+		help='write a replay of each simulated battle to DIR')
+	parser.add_argument('--replay', nargs='+', metavar='FILE',
+		help='play replay files headless and report the results')
+	parser.add_argument('--show', action='store_true',
+		help='watch --replay files in the game window instead')
+	parser.add_argument('--delay', type=int, default=REPLAY_DELAY,
+		help='milliseconds between commands for --show (default: ' + str(REPLAY_DELAY) + ')')
+	parser.add_argument('--search', type=float, metavar='SECONDS',
+		help='AI players plan each turn with a tree search lasting SECONDS instead of the greedy AI')
+	parser.add_argument('--search-player', type=int, choices=[1, 2],
+		help='only this player uses the searching AI (default: every AI player)')
+	args = parser.parse_args()
+	
+	if args.search is not None:
+		if args.search_player is not None:
+			players = [args.search_player - 1]
+		else:
+			players = [0, 1]
+		# simulated battles are already played in parallel, so each one
+		# searches in its own worker process
+		if args.simulate is not None:
+			search_ai = SearchAI(args.search, 0, players)
+		else:
+			search_ai = SearchAI(args.search, max(1, args.workers), players)
+			search_ai.StartPool()
+	
+	if args.simulate is not None:
+		RunSimulation(args.simulate, max(1, args.workers), args.seed, args.record, search_ai)
+	
+	elif args.replay is not None and not args.show:
+		RunReplays(args.replay)
+	
+	else:
+		# set up basic stuff
+		os.environ['SDL_VIDEO_CENTERED'] = '1'		# center window on screen
+		libtcod.console_set_custom_font('terminal10x16_gs_ro.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_ASCII_INROW)
+		libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'WarHexer', False)
+		libtcod.sys_set_fps(LIMIT_FPS)
+		libtcod.console_set_keyboard_repeat(0, 0)
+		
+		# create the main display console
+		con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+		libtcod.console_set_default_background(con, libtcod.black)
+		libtcod.console_set_default_foreground(con, libtcod.white)
+		libtcod.console_set_alignment(con, libtcod.LEFT)
+		libtcod.console_clear(con)
+		
+		# create mouse and key event holders
+		mouse = libtcod.Mouse()
+		key = libtcod.Key()
+		
+		# TEMP - for testing
+		#DoBattle(None)
+		
+		# watch replays, or display the main game menu
+		if args.replay is not None:
+			ShowReplays(args.replay, args.delay)
+		else:
+			MainMenu()
 
 # END #